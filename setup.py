@@ -24,8 +24,15 @@ setup(
     },
     url='https://github.com/vburenin/vmock',
     license='MIT',
+    python_requires='>=3.7',
     classifiers=['License :: MIT',
                  'Development Status :: 4 - Beta/Stable',
                  'Intended Audience :: Developers',
-                 'Programming Language :: Python :: 3.4'],
+                 'Programming Language :: Python :: 3',
+                 'Programming Language :: Python :: 3 :: Only',
+                 'Programming Language :: Python :: 3.7',
+                 'Programming Language :: Python :: 3.8',
+                 'Programming Language :: Python :: 3.9',
+                 'Programming Language :: Python :: 3.10',
+                 'Programming Language :: Python :: 3.11'],
 )
@@ -8,11 +8,23 @@ __author__ = 'Volodymyr Burenin'
 
 
 from vmock import mockcontrol
+from vmock import template
+from vmock.template import Placeholder
+from vmock.vmock_defs import ENGINE_DESCRIPTOR
+from vmock.vmock_defs import ENGINE_SOURCE
 
 
 class VMock(object):
-    def __init__(self):
-        self._mc = mockcontrol.MockControl()
+    def __init__(self, engine=ENGINE_SOURCE):
+        """Constructor.
+
+        :param engine: Fake class engine used by mock_class/stub_class.
+                ENGINE_SOURCE generates and executes fake class source code,
+                ENGINE_DESCRIPTOR builds fake class of mock descriptors
+                without code generation, it also supports attribute names
+                that are not valid identifiers.
+        """
+        self._mc = mockcontrol.MockControl(engine)
 
     def mock_constructor(self, module, class_name,
                          arg_spec=None, display_name=None):
@@ -204,9 +216,26 @@ class VMock(object):
         return self.stub_method(fsc, 'stub', arg_spec=arg_spec,
                                 display_name=display_name)
 
-    def replay(self):
-        """Switches from recording to replay mode."""
-        self._mc.replay()
+    def virtual_clock(self, start=None):
+        """Stubs time module functions with a virtual clock.
+
+        time.time, time.monotonic, time.perf_counter and time.sleep are
+        stubbed together, sleep advances the clock instead of sleeping.
+        asyncio.sleep advances the clock too, event loop timers keep
+        real time.
+
+        :param start: Initial value of time.time(), current time if None.
+        :return: VirtualClock object.
+        """
+        return self._mc.virtual_clock(start)
+
+    def replay(self, thread_safe=False):
+        """Switches from recording to replay mode.
+
+        :param thread_safe: Allow mocks to be called by many threads.
+                Ordered expectations must be called in strict global order.
+        """
+        self._mc.replay(thread_safe)
 
     def verify(self):
         """Do post execution verification.
@@ -218,3 +247,71 @@ class VMock(object):
     @property
     def tear_down(self):
         return self._mc.tear_down
+
+    def reset(self):
+        """Restores mocked objects and switches back to record mode.
+
+        All recorded actions are released, generated fake classes are kept
+        for reuse, so the same VMock may be used by many tests.
+        """
+        self._mc.reset()
+
+    def savepoint(self):
+        """Makes a savepoint of recorded expectations.
+
+        Use it to record a common baseline once and roll back to it
+        in each test.
+
+        :return: Savepoint object for rollback().
+        """
+        return self._mc.savepoint()
+
+    def rollback(self, savepoint):
+        """Rolls recorded expectations back to the savepoint.
+
+        Mocks, stubs and expectations recorded after the savepoint are
+        dropped, call counters are restored and VMock switches to record
+        mode.
+
+        :param savepoint: Result of savepoint() call.
+        """
+        self._mc.rollback(savepoint)
+
+    def capture_template(self):
+        """Captures recorded mocks and expectations as a template.
+
+        Template may be applied to other VMock objects without recording
+        the same expectations again. Use Placeholder objects as expected
+        arguments or results to bind them when template is applied.
+
+        :return: ExpectationTemplate object.
+        """
+        return self._mc.capture_template()
+
+    def apply_template(self, template, **bindings):
+        """Installs template mocks and adds template expectations.
+
+        :param template: Result of capture_template() call.
+        :param bindings: Values of placeholders by their names.
+        :return: List of new mocks in order of template mocks.
+        """
+        return template.instantiate(self._mc, **bindings)
+
+    def save_expectations(self, path):
+        """Saves recorded mocks and expectations to a file.
+
+        Only mocks of module functions and class methods can be saved.
+        Expected arguments, matchers and results must be picklable.
+
+        :param path: File path.
+        """
+        self.capture_template().save(path)
+
+    def load_expectations(self, path, **bindings):
+        """Installs mocks and adds expectations saved to a file.
+
+        :param path: File path made by save_expectations.
+        :param bindings: Values of placeholders by their names.
+        :return: List of new mocks in order they were saved.
+        """
+        return self.apply_template(template.load_template(path), **bindings)
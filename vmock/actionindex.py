@@ -0,0 +1,350 @@
+"""Hash based index of recorded call actions.
+"""
+
+import itertools
+
+from vmock import matchers
+from vmock.vmock_defs import CallArgs
+
+
+def make_key(args, kwargs):
+    """Makes hashable lookup key of call arguments.
+
+    :param args: Call args.
+    :param kwargs: Call keyword args.
+    :return: Normalized (args, sorted kwargs) tuple or None if arguments
+            contain matchers or unhashable values.
+    """
+    for val in args:
+        if isinstance(val, matchers.MockMatcher):
+            return None
+    if kwargs:
+        for val in kwargs.values():
+            if isinstance(val, matchers.MockMatcher):
+                return None
+        key = (args, tuple(sorted(kwargs.items())))
+    else:
+        key = (args, ())
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _call_key(call_args):
+    """Makes (args, sorted kwargs items) of one table row call arguments."""
+    if isinstance(call_args, CallArgs):
+        kwargs = call_args.kwargs
+        return (tuple(call_args.args),
+                tuple(sorted(kwargs.items())) if kwargs else ())
+    if isinstance(call_args, tuple):
+        return (tuple(call_args), ())
+    return ((call_args,), ())
+
+
+def make_table_rows(calls, values):
+    """Makes lookup keys of table rows in bulk.
+
+    Rows of plain arguments are keyed by a few passes over the whole list,
+    rows are checked one by one only if some of them have matchers or
+    unhashable arguments.
+
+    :param calls: List of row call arguments. Tuple is used as positional
+            args, CallArgs as args and kwargs, other value as one argument.
+    :param values: List of row values.
+    :return: Tuple of (dict of lookup key -> value, list of (args, kwargs,
+            value) of rows without lookup key, list of (args, kwargs) with
+            one sample of each number of args and kwargs names). Rows with
+            the same key are kept once.
+    """
+    call_types = set(map(type, calls))
+    if not any(issubclass(call_type, tuple) for call_type in call_types):
+        # One argument in each row.
+        keys = list(zip(zip(calls), itertools.repeat(())))
+        arg_types = call_types
+        samples = keys[:1]
+    elif call_types == {tuple}:
+        keys = list(zip(calls, itertools.repeat(())))
+        arg_types = set(map(type, itertools.chain.from_iterable(calls)))
+        samples = [(args, ()) for args in
+                   dict(zip(map(len, calls), calls)).values()]
+    else:
+        keys = [_call_key(call_args) for call_args in calls]
+        arg_types = {type(val) for args, kwargs in keys
+                     for val in itertools.chain(
+                         args, (item[1] for item in kwargs))}
+        samples = list({(len(args), tuple(item[0] for item in kwargs)):
+                        (args, kwargs) for args, kwargs in keys}.values())
+    samples = [(args, dict(kwargs)) for args, kwargs in samples]
+
+    if not any(issubclass(arg_type, matchers.MockMatcher)
+               for arg_type in arg_types):
+        try:
+            return dict(zip(keys, values)), [], samples
+        except TypeError:
+            pass
+
+    table_rows = {}
+    other_rows = []
+    for (args, kwargs), value in zip(keys, values):
+        kwargs = dict(kwargs)
+        key = make_key(args, kwargs)
+        if key is None:
+            other_rows.append((args, kwargs, value))
+        else:
+            table_rows[key] = value
+    return table_rows, other_rows, samples
+
+
+class ActionTable(object):
+
+    """Table of actions with exact arguments added by one call.
+
+    Actions are made on first lookup of their arguments, so a large table
+    costs one dict until its rows are called. Table is an ActionIndex entry
+    like MockCallAction, see ActionIndex.
+    """
+
+    __slots__ = ('rows', 'make_action', 'make_state', 'actions')
+
+    # Tables are never looked up by key as a whole.
+    lookup_key = None
+
+    def __init__(self, rows, make_action, make_state):
+        """Constructor.
+
+        :param rows: Dict of lookup key -> result value.
+        :param make_action: Function making action of (lookup key, value).
+        :param make_state: Function making state of the action of
+                (lookup key, value) without making the action.
+        """
+        self.rows = rows
+        self.make_action = make_action
+        self.make_state = make_state
+        # Actions that are made already.
+        self.actions = {}
+
+    def get(self, key):
+        """Returns action of the lookup key or None."""
+        action = self.actions.get(key)
+        if action is None and key in self.rows:
+            # setdefault keeps one action if threads make it at once.
+            action = self.actions.setdefault(
+                key, self.make_action(key, self.rows[key]))
+        return action
+
+    def _set_tracked(self, tracked, seq=0):
+        """Actions of tables are called any times, they are not tracked."""
+
+    def _entry_actions(self):
+        for key in self.rows:
+            yield self.get(key)
+
+    def _made_actions(self):
+        return self.actions.values()
+
+    def _entry_states(self):
+        actions = self.actions
+        for key, value in self.rows.items():
+            action = actions.get(key)
+            if action is None:
+                yield self.make_state(key, value)
+            else:
+                yield action._get_state()
+
+    def _entry_find(self, args, kwargs, key=None):
+        if key is not None:
+            return self.get(key)
+        if len(args) == 1 and isinstance(args[0], matchers.AnyArgsMatcher):
+            for key in self.rows:
+                return self.get(key)
+            return None
+        for key in self.rows:
+            if key[0] == args and dict(key[1]) == kwargs:
+                return self.get(key)
+        return None
+
+    def _entry_accepted(self, action):
+        key = action.lookup_key
+        if key is not None:
+            return self.get(key)
+        for key in self.rows:
+            if action._compare_args(key[0], dict(key[1])):
+                return self.get(key)
+        return None
+
+    def _entry_has_key(self, key):
+        return key in self.rows
+
+    def _entry_has_any_key(self, keys):
+        return not self.rows.keys().isdisjoint(keys)
+
+
+class ActionIndex(object):
+
+    """Storage of call actions of one method mock.
+
+    Actions with hashable matcher-free arguments are looked up by key,
+    all others are checked one by one. Lookup result is the same as if all
+    actions were scanned in the order they were added.
+
+    Stored entries are MockCallAction or ActionTable objects, both have
+    lookup_key and the entry methods:
+        _entry_actions(): Iterates actions of the entry.
+        _made_actions(): Iterates actions that exist already.
+        _entry_states(): Iterates states of actions of the entry, see
+            MockCallAction._get_state.
+        _entry_find(args, kwargs, key=None): Action accepting the call
+            arguments, key is given if they are hashable.
+        _entry_accepted(action): Stored action which arguments are
+            accepted by the new action.
+        _entry_has_key(key): Checks if the entry accepts exact arguments
+            of the lookup key.
+        _entry_has_any_key(keys): Checks if the entry accepts exact
+            arguments of any of the lookup keys.
+    """
+
+    def __init__(self):
+        # All entries in order they were added.
+        self._actions = []
+        # Lookup key -> (position, action) of the first action with that key.
+        self._exact = {}
+        # (position, entry) of entries that can not be looked up by key.
+        self._fallback = []
+
+    def __iter__(self):
+        for entry in self._actions:
+            yield from entry._entry_actions()
+
+    def __len__(self):
+        return len(self._actions)
+
+    def made_actions(self):
+        """Iterates actions, rows of tables that are not made are skipped."""
+        for entry in self._actions:
+            yield from entry._made_actions()
+
+    def states(self):
+        """Iterates states of actions without making actions of tables."""
+        for entry in self._actions:
+            yield from entry._entry_states()
+
+    def has_duplicate(self, key):
+        """Checks if exact action with the lookup key is a duplicate.
+
+        It is the same as find_duplicate for action without matchers.
+
+        :param key: Lookup key made by make_key.
+        :return: True if stored action accepts the same arguments.
+        """
+        if key in self._exact:
+            return True
+        for _, stored in self._fallback:
+            if stored._entry_has_key(key):
+                return True
+        return False
+
+    def has_any_duplicate(self, keys):
+        """Checks many lookup keys at once, see has_duplicate.
+
+        :param keys: Set-like collection of lookup keys.
+        :return: True if stored action accepts arguments of any key.
+        """
+        if not self._exact.keys().isdisjoint(keys):
+            return True
+        for _, stored in self._fallback:
+            if stored._entry_has_any_key(keys):
+                return True
+        return False
+
+    def add(self, action):
+        """Adds new entry to the index.
+
+        :param action: MockCallAction or ActionTable object.
+        """
+        pos = len(self._actions)
+        self._actions.append(action)
+        key = action.lookup_key
+        if key is None:
+            self._fallback.append((pos, action))
+        elif key not in self._exact:
+            self._exact[key] = (pos, action)
+
+    def pop(self):
+        """Removes the last added entry.
+
+        :return: Removed MockCallAction or ActionTable object.
+        """
+        action = self._actions.pop()
+        key = action.lookup_key
+        if key is None:
+            self._fallback.pop()
+        else:
+            hit = self._exact.get(key)
+            if hit is not None and hit[1] is action:
+                del self._exact[key]
+        return action
+
+    def find(self, args, kwargs):
+        """Finds the first action that accepts call arguments.
+
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        :return: MockCallAction object or None.
+        """
+        # Matchers in actual arguments don't need special handling, they are
+        # either unhashable or compared by identity like in _compare_args.
+        # Only the any arguments matcher accepts everything.
+        if len(args) == 1 and isinstance(args[0], matchers.AnyArgsMatcher):
+            return self._scan(args, kwargs)
+        if kwargs:
+            key = (args, tuple(sorted(kwargs.items())))
+        else:
+            key = (args, ())
+        try:
+            hit = self._exact.get(key)
+        except TypeError:
+            return self._scan(args, kwargs)
+
+        if not self._fallback:
+            return None if hit is None else hit[1]
+
+        limit = len(self._actions) if hit is None else hit[0]
+        # Matcher actions added before exact one have higher priority.
+        for pos, entry in self._fallback:
+            if pos > limit:
+                break
+            action = entry._entry_find(args, kwargs, key)
+            if action is not None:
+                return action
+        return None if hit is None else hit[1]
+
+    def _scan(self, args, kwargs):
+        """Checks all entries one by one."""
+        for entry in self._actions:
+            action = entry._entry_find(args, kwargs)
+            if action is not None:
+                return action
+        return None
+
+    def find_duplicate(self, action):
+        """Finds stored action which arguments are accepted by given action.
+
+        :param action: New MockCallAction object.
+        :return: Conflicting MockCallAction object or None.
+        """
+        key = action.lookup_key
+        if key is None:
+            # Matchers of the new action may accept any stored arguments.
+            entries = self._actions
+        else:
+            hit = self._exact.get(key)
+            if hit is not None:
+                return hit[1]
+            entries = (entry for _, entry in self._fallback)
+        for stored in entries:
+            found = stored._entry_accepted(action)
+            if found is not None:
+                return found
+        return None
@@ -0,0 +1,70 @@
+"""Virtual clock for time module stubs.
+"""
+
+import asyncio
+import threading
+import time
+
+
+# Bound at import, the clock yields to event loops with the real sleep.
+_async_sleep = asyncio.sleep
+
+
+class VirtualClock(object):
+
+    """Clock that moves only when code sleeps or the clock is advanced.
+
+    time() counts from the start time, monotonic() and perf_counter()
+    count from zero. sleep() advances the clock and returns immediately,
+    async_sleep() advances it and only yields to the event loop.
+    """
+
+    # Functions of time module replaced by the clock methods.
+    FUNCTIONS = ('time', 'monotonic', 'perf_counter', 'sleep')
+
+    def __init__(self, start=None):
+        """Constructor.
+
+        :param start: Initial value of time(), current time if None.
+        """
+        if start is None:
+            start = time.time()
+        self.__start = start
+        self.__elapsed = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        """Seconds passed since the clock was started."""
+        return self.__elapsed
+
+    def time(self):
+        return self.__start + self.__elapsed
+
+    def monotonic(self):
+        return self.__elapsed
+
+    def perf_counter(self):
+        return self.__elapsed
+
+    def sleep(self, secs):
+        """Advances the clock instead of sleeping."""
+        if secs < 0:
+            raise ValueError('sleep length must be non-negative')
+        self.advance(secs)
+
+    async def async_sleep(self, delay, result=None):
+        """Advances the clock instead of sleeping in the event loop."""
+        self.advance(max(delay, 0))
+        await _async_sleep(0)
+        return result
+
+    def advance(self, secs):
+        """Moves the clock forward.
+
+        :param secs: Number of seconds.
+        """
+        if secs < 0:
+            raise ValueError('Clock can not go backwards')
+        with self.__lock:
+            self.__elapsed += secs
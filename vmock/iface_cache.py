@@ -0,0 +1,126 @@
+"""On-disk cache of class interface snapshots.
+
+Snapshot is a description of class attributes that is enough to generate
+a fake class without scanning the class again. Cache is disabled by
+default, set VMOCK_CACHE_DIR environment variable or call set_cache_dir
+to enable it. Entries are invalidated when any source file of the class
+hierarchy is changed.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+
+FORMAT_VERSION = 2
+
+_cache_dir = os.environ.get('VMOCK_CACHE_DIR') or None
+
+
+def set_cache_dir(path):
+    """Enables snapshot cache in the directory, None disables it.
+
+    :param path: Cache directory path.
+    """
+    global _cache_dir
+    _cache_dir = path
+
+
+def get_cache_dir():
+    """Returns current cache directory or None if cache is disabled."""
+    return _cache_dir
+
+
+def _class_stamps(class_def):
+    """Returns source file stamps of the class hierarchy.
+
+    :return: Tuple of (file path, mtime, size) or None if class
+            can not be cached.
+    """
+    if '<locals>' in class_def.__qualname__:
+        return None
+
+    module = sys.modules.get(class_def.__module__)
+    owner = module
+    for name in class_def.__qualname__.split('.'):
+        owner = getattr(owner, name, None)
+    # Classes generated in runtime can not be found by name.
+    if owner is not class_def:
+        return None
+
+    stamps = []
+    for cls in class_def.__mro__:
+        if cls is object:
+            continue
+        module = sys.modules.get(cls.__module__)
+        path = getattr(module, '__file__', None)
+        if path is None:
+            if cls.__module__ in sys.builtin_module_names:
+                continue
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stamps.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+
+def _entry_path(class_def):
+    """Cache file path for the class."""
+    full_name = '%s.%s' % (class_def.__module__, class_def.__qualname__)
+    digest = hashlib.sha1(full_name.encode('utf-8')).hexdigest()
+    return os.path.join(_cache_dir, '%s.%s.vmc' % (
+        digest, sys.implementation.cache_tag))
+
+
+def load(class_def):
+    """Loads interface snapshot of the class.
+
+    :param class_def: Class definition.
+    :return: Snapshot or None if it is not cached or outdated.
+    """
+    if _cache_dir is None:
+        return None
+    stamps = _class_stamps(class_def)
+    if stamps is None:
+        return None
+    try:
+        with open(_entry_path(class_def), 'rb') as f:
+            version, cached_stamps, snapshot = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != FORMAT_VERSION or cached_stamps != stamps:
+        return None
+    return snapshot
+
+
+def save(class_def, snapshot):
+    """Saves interface snapshot of the class.
+
+    Errors are ignored since cache is only an optimization.
+
+    :param class_def: Class definition.
+    :param snapshot: Snapshot built of tuples, strings, ints and None.
+    """
+    if _cache_dir is None:
+        return
+    stamps = _class_stamps(class_def)
+    if stamps is None:
+        return
+    try:
+        data = marshal.dumps((FORMAT_VERSION, stamps, snapshot))
+        os.makedirs(_cache_dir, exist_ok=True)
+        # Write to temporary file first, other processes may read the entry.
+        fd, tmp_path = tempfile.mkstemp(dir=_cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, _entry_path(class_def))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except (OSError, ValueError):
+        pass
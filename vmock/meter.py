@@ -0,0 +1,99 @@
+"""Concurrency meter of mock calls.
+"""
+
+import threading
+import time
+
+
+# Bound at import, meter measures real time under virtual clock too.
+_perf_counter = time.perf_counter
+
+
+class ConcurrencyMeter(object):
+
+    """Measures how many calls of a mock are in flight at once.
+
+    Sync call is in flight while the mock is called, async call is in
+    flight from the first run of its coroutine until it is done. Meter is
+    thread-safe.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__in_flight = 0
+        self.__peak = 0
+        self.__calls = 0
+        # Concurrency level -> seconds spent on that level.
+        self.__histogram = {}
+        # Time of the last level change.
+        self.__changed = None
+
+    @property
+    def in_flight(self):
+        """Number of calls in flight now."""
+        return self.__in_flight
+
+    @property
+    def peak(self):
+        """Max number of calls that were in flight at once."""
+        return self.__peak
+
+    @property
+    def calls(self):
+        """Number of measured calls."""
+        return self.__calls
+
+    def histogram(self):
+        """Returns time spent on each concurrency level.
+
+        Time is counted from the first call till now.
+
+        :return: Dict of number of calls in flight -> seconds.
+        """
+        with self.__lock:
+            histogram = dict(self.__histogram)
+            if self.__changed is not None:
+                level = self.__in_flight
+                histogram[level] = (histogram.get(level, 0.0) +
+                                    _perf_counter() - self.__changed)
+        return histogram
+
+    def reset(self):
+        """Resets measured values, calls in flight are kept."""
+        with self.__lock:
+            self.__peak = self.__in_flight
+            self.__calls = 0
+            self.__histogram = {}
+            self.__changed = None
+
+    def enter(self):
+        """Marks start of a call."""
+        with self.__lock:
+            self.__level_changed()
+            self.__in_flight += 1
+            self.__calls += 1
+            if self.__in_flight > self.__peak:
+                self.__peak = self.__in_flight
+
+    def exit(self):
+        """Marks end of a call."""
+        with self.__lock:
+            self.__level_changed()
+            self.__in_flight -= 1
+
+    def measure(self, func, *args):
+        """Calls the function as one measured call."""
+        self.enter()
+        try:
+            return func(*args)
+        finally:
+            self.exit()
+
+    def __level_changed(self):
+        """Adds time spent on the current level to the histogram."""
+        now = _perf_counter()
+        if self.__changed is not None:
+            level = self.__in_flight
+            self.__histogram[level] = (self.__histogram.get(level, 0.0) +
+                                       now - self.__changed)
+        self.__changed = now
@@ -2,12 +2,54 @@
 """
 
 import inspect
-import functools
 
 from vmock import matchers
+from vmock import meter
+from vmock import vmock_defs
+from vmock.mockcallaction import MockCallResult
 from vmock.mockerrors import CallSequenceError
 from vmock.mockerrors import InterfaceError
-from vmock.mockerrors import UnexpectedCall
+
+
+# Interface validators shared by all mocks with the same arguments.
+_validators = {}
+
+
+def _build_signature(spec_key):
+    """Builds call signature from hashable argument specification."""
+    args, varargs, varkw, defaults_num, kwonlyargs, kwonlydefaults = spec_key
+    params = []
+    first_default = len(args) - defaults_num
+    for i, name in enumerate(args):
+        default = None if i >= first_default else inspect.Parameter.empty
+        params.append(inspect.Parameter(
+            name, inspect.Parameter.POSITIONAL_OR_KEYWORD, default=default))
+    if varargs:
+        params.append(inspect.Parameter(
+            varargs, inspect.Parameter.VAR_POSITIONAL))
+    for name in kwonlyargs:
+        default = None if name in kwonlydefaults else inspect.Parameter.empty
+        params.append(inspect.Parameter(
+            name, inspect.Parameter.KEYWORD_ONLY, default=default))
+    if varkw:
+        params.append(inspect.Parameter(varkw, inspect.Parameter.VAR_KEYWORD))
+    return inspect.Signature(params)
+
+
+def get_validator(arg_spec, skip_first=False):
+    """Returns cached interface validator for the argument specification.
+
+    Validator is a callable that raises TypeError if call arguments
+    don't fit the interface.
+
+    :param arg_spec: inspect.FullArgSpec object.
+    :param skip_first: Skip first positional argument such as 'self'.
+    """
+    spec_key = vmock_defs.arg_spec_key(arg_spec, skip_first)
+    validator = _validators.get(spec_key)
+    if validator is None:
+        validator = _validators[spec_key] = _build_signature(spec_key).bind
+    return validator
 
 
 class MethodMock(object):
@@ -18,6 +60,9 @@ class MethodMock(object):
     and store them in appropriate queue that depends on type of Mock Call.
     """
 
+    __slots__ = ('_func_def', '_validator', '_mc', '_display_name',
+                 '_meter', '__weakref__')
+
     def __init__(self, func_def, mock_control, display_name):
         """Constructor.
 
@@ -29,37 +74,10 @@ class MethodMock(object):
         # Method/Function argument specification.
 
         self._func_def = func_def
-        spec = func_def.arg_spec
 
         # If it is class method, let skip first 'self' parameter.
-        if func_def.kind in ('method', 'class method'):
-            if func_def.arg_spec.args:
-                func_def.arg_spec.args.pop(0)
-
-        defaults = None if spec.defaults is None else [
-            0 for _ in spec.defaults]
-        kwonlydefaults = None if spec.kwonlydefaults is None else {
-            k: 0 for k in spec.kwonlydefaults}
-
-        # [1:-1] removes parenthesis.
-        txt_args = inspect.formatargspec(
-            spec.args,
-            varargs=spec.varargs,
-            varkw=spec.varkw,
-            defaults=defaults,
-            kwonlyargs=spec.kwonlyargs,
-            kwonlydefaults=kwonlydefaults)[1:-1]
-
-        try:
-            lambda_func = eval('lambda %s: None' % (txt_args,))
-        except SyntaxError:
-            # This should never happen unless there is a bug in vmock.
-            import sys
-            print(func_def.name, file=sys.stderr)
-            print('lambda %s: None' % (txt_args,), file=sys.stderr)
-            raise
-
-        self._func = functools.wraps(func_def.func)(lambda_func)
+        skip_first = func_def.kind in ('method', 'class method')
+        self._validator = get_validator(func_def.arg_spec, skip_first)
 
         # Parent Mock Control.
         self._mc = mock_control
@@ -67,6 +85,9 @@ class MethodMock(object):
         # Name to be displayed for this method mock.
         self._display_name = display_name
 
+        # ConcurrencyMeter of replayed calls, calls are not measured if None.
+        self._meter = None
+
     def __call__(self, *args, **kwargs):
         """Record or execute expected call.
 
@@ -81,8 +102,9 @@ class MethodMock(object):
         # Each mock call records an error if such has happened, since it may be
         # handled by function which you are testing. So, each next call of
         # other mocks will throw saved error.
-        self._mc.check_error()
-        if self._mc.is_recording():
+        mc = self._mc
+        mc.check_error()
+        if mc.is_recording():
             return self._save_call(args, kwargs)
         else:
             return self._make_call(args, kwargs)
@@ -98,6 +120,18 @@ class MethodMock(object):
         """Mocked method name"""
         return self._func_def.name
 
+    def returns_table(self, rows):
+        """Adds non-ordered expectations for each row of the table.
+
+        Each call with row arguments returns row value, it is the same as
+        mock(*args, **kwargs).returns(value).anyorder() for each row.
+
+        :param rows: Mapping or iterable of (call arguments, value) pairs.
+                Tuple of call arguments is used as positional args,
+                CallArgs as args and kwargs, other value as one argument.
+        """
+        self._mc.add_table(self, rows, False)
+
     def _verify_interface(self, args, kwargs):
         """Verify mock call with original function interface.
 
@@ -111,9 +145,9 @@ class MethodMock(object):
             return
 
         try:
-            self._func(*args, **kwargs)
+            self._validator(*args, **kwargs)
         except TypeError as e:
-            err_txt = e.args[0].replace('<lambda>', self._func_def.name, 1)
+            err_txt = '%s(): %s' % (self._func_def.name, e.args[0])
             raise InterfaceError(err_txt) from None
 
     def _restore_original(self):
@@ -140,34 +174,19 @@ class MethodMock(object):
         :raise: CallSequenceError or UnexpectedCall if call is unexpected.
         """
 
-        # Find stub first.
-        e_data = self._mc.find_stub(self, a_args, a_kwargs)
+        if self._meter is not None:
+            return self._meter.measure(self._mc.make_call, self, a_args,
+                                       a_kwargs)
+        return self._mc.make_call(self, a_args, a_kwargs)
 
-        # If there are no stubs, get call from the queue of expectors
-        if e_data is None:
-            e_data = self._mc.pop_current_record()
+    def measure_concurrency(self):
+        """Starts measuring concurrency of replayed calls.
 
-        # Failure if there are no stubs and expectors in the queue.
-        if e_data is None:
-            error = CallSequenceError(
-                'No more calls are expected. \n'
-                'Actual call: %s, with args: %s' %
-                (str(self), self._args_to_str(a_args, a_kwargs)))
-            self._mc.raise_error(error)
-
-        if e_data.obj != self or not e_data._compare_args(a_args, a_kwargs):
-            err_str = ('Unexpected method call.\n'
-                       'Expected object: %s\n'
-                       'Expected args: %s\n'
-                       'Actual object: %s\n'
-                       'Actual args: %s\n')
-            fmt_params = (str(e_data.obj),
-                          self._args_to_str(e_data.args, e_data.kwargs),
-                          str(self), self._args_to_str(a_args, a_kwargs))
-            error = UnexpectedCall(err_str % fmt_params)
-            self._mc.raise_error(error)
-
-        return e_data._get_result(*a_args, **a_kwargs)
+        :return: ConcurrencyMeter of the mock, the same one on each call.
+        """
+        if self._meter is None:
+            self._meter = meter.ConcurrencyMeter()
+        return self._meter
 
     @staticmethod
     def _args_to_str(args, kwargs):
@@ -193,6 +212,8 @@ class MethodStub(MethodMock):
 
     """Used for immediate response after mocking."""
 
+    __slots__ = ()
+
     def __call__(self, *args, **kwargs):
         self._mc.check_error()
         e_data = self._mc.find_static_mock(self, args, kwargs)
@@ -206,9 +227,108 @@ class MethodStub(MethodMock):
                     'Actual call: %s, with args: %s' %
                     (str(self), self._args_to_str(args, kwargs))))
         else:
-            return e_data._get_result(*args, **kwargs)
+            return self._get_result(e_data, args, kwargs)
+
+    def _get_result(self, action, args, kwargs):
+        """Returns result of found static action."""
+        if self._meter is not None:
+            call_meter = self._call_meter()
+            if call_meter is not None:
+                return call_meter.measure(self._mc.get_result, action, args,
+                                          kwargs)
+        return self._mc.get_result(action, args, kwargs)
+
+    def _call_meter(self):
+        """Returns meter of the call, calls in record mode are not measured.
+        """
+        if self._meter is None or self._mc.is_recording():
+            return None
+        return self._meter
+
+    def returns_table(self, rows):
+        """Adds static stub actions for each row of the table.
+
+        :param rows: Mapping or iterable of (call arguments, value) pairs.
+                Tuple of call arguments is used as positional args,
+                CallArgs as args and kwargs, other value as one argument.
+        """
+        self._mc.add_table(self, rows, True)
 
     def redefine(self, *args, **kwargs):
         """Redefine stub action."""
 
         return self._mc.redefine_static_action(self, args, kwargs)
+
+
+async def _await_result(mc, action, args, kwargs):
+    """Makes result of counted action when async mock call is awaited.
+
+    Result of a custom function is awaited if it is awaitable.
+    """
+    result = mc.make_result(action, args, kwargs)
+    if (action.result[0] == MockCallResult.EXECUTE_FUNCTION and
+            inspect.isawaitable(result)):
+        result = await result
+    return result
+
+
+async def _await_measured(call_meter, mc, action, args, kwargs):
+    """Awaits the result of a call measured from the first run."""
+    call_meter.enter()
+    try:
+        return await _await_result(mc, action, args, kwargs)
+    finally:
+        call_meter.exit()
+
+
+def _async_result(call_meter, mc, action, args, kwargs):
+    """Returns coroutine of counted async call.
+
+    Measured call is in flight from the first run of its coroutine until
+    it is done, coroutines waiting for their turn are not in flight.
+    """
+    if call_meter is None:
+        return _await_result(mc, action, args, kwargs)
+    return _await_measured(call_meter, mc, action, args, kwargs)
+
+
+class AsyncMethodMock(MethodMock):
+
+    """Mock of coroutine function.
+
+    Expectations are recorded the same way as for MethodMock. In replay
+    mode the call is checked and counted immediately, the call returns
+    a coroutine that makes the result when it is awaited.
+    """
+
+    __slots__ = ()
+
+    def _make_call(self, a_args, a_kwargs):
+        action = self._mc.count_call(self, a_args, a_kwargs)
+        return _async_result(self._meter, self._mc, action, a_args, a_kwargs)
+
+
+class AsyncMethodStub(MethodStub):
+
+    """Stub of coroutine function, see AsyncMethodMock."""
+
+    __slots__ = ()
+
+    def _get_result(self, action, args, kwargs):
+        self._mc.count_action(action)
+        return _async_result(self._call_meter(), self._mc, action, args,
+                             kwargs)
+
+
+def new_mock(func_def, mock_control, display_name):
+    """Creates MethodMock, or AsyncMethodMock for coroutine function."""
+    if func_def.is_async:
+        return AsyncMethodMock(func_def, mock_control, display_name)
+    return MethodMock(func_def, mock_control, display_name)
+
+
+def new_stub(func_def, mock_control, display_name):
+    """Creates MethodStub, or AsyncMethodStub for coroutine function."""
+    if func_def.is_async:
+        return AsyncMethodStub(func_def, mock_control, display_name)
+    return MethodStub(func_def, mock_control, display_name)
@@ -3,10 +3,11 @@
 
 import inspect
 import types
+import weakref
 
+from vmock import iface_cache
+from vmock import methodmock
 from vmock import vmock_defs
-from vmock.methodmock import MethodMock
-from vmock.methodmock import MethodStub
 
 
 CLASS_TMPL = """
@@ -16,58 +17,130 @@ class {0}(object):
         self.__mocker = mocker
         self.__interface = interface
         self.__m = dict()
-        for v in var_list:
-            setattr(self, v.name, v.object)
-            setattr(self.__class__, v.name, v.object)
-        """
+        for name, value in var_list:
+            setattr(self, name, value)
+            setattr(self.__class__, name, value)
 
+    def __mock(self, name, display_name):
+        mock = self.__m.get(name)
+        if mock is None:
+            mock = self.__mocker(self.__interface[name], self.__mc,
+                                 display_name)
+            self.__m[name] = mock
+        return mock
+
+    def _vmock_bind(self, name):
+        mock = self.__m.get(name)
+        if mock is None:
+            mock = self.__mocker(self.__interface[name], self.__mc, None)
+            self.__m[name] = mock
+            self.__dict__[name] = mock
+        return mock
+"""
 
-TMPL_MOCKER_PROP = """
-        self.__m['{0}__get_prop'] = mocker(interface['{0}__get_prop'],
-                                       mc, 'get_' + '{0}')
-        self.__m['{0}__set_prop'] = mocker(interface['{0}__set_prop'],
-                                       mc, 'set_' + '{0}')
-        self.__m['{0}__del_prop'] = mocker(interface['{0}__del_prop'],
-                                       mc, 'del_' + '{0}')"""
 
+# Method mock is created on first access and bound to the instance, so
+# next calls go to the mock directly. Special methods are looked up in the
+# class, they get the mock from self.__m.
 METHOD_TMPL = """
     def {0}(self, *args, **kwargs):
-        if '{0}' not in self.__m:
-            self.__m['{0}'] = self.__mocker(self.__interface['{0}'],
-                                            self.__mc, None)
-        return self.__m['{0}'](*args, **kwargs)"""
+        return self._vmock_bind('{0}')(*args, **kwargs)
+    {0} = _vmock_method({0})"""
+
+
+class MethodAttribute(object):
+
+    """Non-data descriptor of generated method.
+
+    Access by instance returns the method mock, access by class returns
+    the generated function.
+    """
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.func
+        return instance._vmock_bind(self.func.__name__)
 
+
+# Property mocks are created on first access.
 PROP_TMPL = """
     @property
     def {0}(self):
-        return self.__m['{0}__get_prop']()
+        return self.__mock('{0}__get_prop', 'get_{0}')()
 
     @{0}.setter
     def {0}(self, value):
-        self.__m['{0}__set_prop'](value)
+        self.__mock('{0}__set_prop', 'set_{0}')(value)
 
     @{0}.deleter
     def {0}(self):
-        self.__m['{0}__del_prop']()"""
+        self.__mock('{0}__del_prop', 'del_{0}')()"""
 
 
-def init_fake_class(mc, class_def, class_name, is_stub):
-    """Initializes fake class.
+class _ClassCache(object):
 
-    :param MockControl mc: Mockcontrol instance.
-    :param class_def: Class definition to mock.
-    :param class_name: Class name.
-    :param is_stub: If True makes method stubs.
+    """Interface and generated fake classes of one class definition."""
+
+    def __init__(self, fingerprint, interface, var_names):
+        self.fingerprint = fingerprint
+        self.interface = interface
+        self.var_names = var_names
+        # (engine, is_stub, class_name) -> generated fake class.
+        self.fake_classes = {}
+
+
+# Class definition -> _ClassCache. Entries go away with their classes.
+_class_cache = weakref.WeakKeyDictionary()
+
+
+def _class_fingerprint(class_def):
+    """Cheap snapshot of class hierarchy to detect class changes.
+
+    Attributes added to or removed from any class of the hierarchy change
+    the fingerprint, attributes replaced in place do not.
     """
+    return tuple(len(cls.__dict__) for cls in class_def.__mro__)
 
-    if is_stub:
-        mocker = MethodStub
-    else:
-        mocker = MethodMock
 
-    interface = {}
-    var_list = []
+def _class_attr(class_def, name):
+    """Returns class attribute value the way inspect.classify_class_attrs does.
+
+    Descriptors are resolved by getattr, the raw value from the class dict
+    is used only if getattr fails.
+    """
+    try:
+        return getattr(class_def, name)
+    except Exception:
+        for cls in class_def.__mro__:
+            if name in vars(cls):
+                return vars(cls)[name]
+        raise
+
+
+def get_var_list(class_def, var_names):
+    """Returns (name, value) pairs of class data attributes to copy."""
+    return [(name, _class_attr(class_def, name)) for name in var_names]
+
+
+def _scan_class(class_def):
+    """Scans class definition and makes its interface snapshot.
+
+    Methods replaced by vmock mocks are described by their original
+    functions, so fakes never copy mocks or originals as data attributes.
+
+    :param class_def: Class definition to scan.
+    :return: Tuple of snapshot and flag whether the class is patched by
+            mocks. Snapshot is a tuple of (name, kind, arg spec key,
+            is async) tuples. Arg spec key is None for properties and data
+            attributes.
+    """
+    snapshot = []
+    is_patched = False
 
     for attr in inspect.classify_class_attrs(class_def):
         if attr.name in vmock_defs.NOT_MOCKABLE_METHODS:
@@ -77,47 +150,152 @@ def init_fake_class(mc, class_def, class_name, is_stub):
         if attr.defining_class is object:
             continue
 
-        try:
-            arg_spec = inspect.getfullargspec(getattr(class_def, attr.name))
-        except TypeError:
-            arg_spec = vmock_defs.ANY_ARGS_SPEC
+        kind = attr.kind
+        spec_key = None
+        is_async = False
+        if isinstance(attr.object, methodmock.MethodMock):
+            is_patched = True
+            method = attr.object._func_def.func
+            kind = 'class method' if inspect.ismethod(method) else 'method'
+        elif kind == 'data':
+            if attr.name.startswith('__') and attr.name.endswith('__'):
+                continue
+        elif kind != 'property':
+            method = getattr(class_def, attr.name)
+        if kind not in ('data', 'property'):
+            try:
+                arg_spec = inspect.getfullargspec(method)
+            except TypeError:
+                arg_spec = vmock_defs.ANY_ARGS_SPEC
+            spec_key = vmock_defs.arg_spec_key(arg_spec)
+            is_async = inspect.iscoroutinefunction(method)
+        snapshot.append((attr.name, kind, spec_key, is_async))
 
-        func_def = vmock_defs.FuncDef(name=attr.name, kind=attr.kind,
-                                      func=None, arg_spec=arg_spec, owner=None)
-        if attr.kind == 'property':
-            interface[attr.name + '__get_prop'] = vmock_defs.FuncDef(
-                name=attr.name, kind=attr.kind, func=None,
+    return tuple(snapshot), is_patched
+
+
+def get_class_interface(class_def, rescan=False):
+    """Describes class attributes to mock.
+
+    Interface snapshot is taken from the on-disk cache if it is enabled,
+    otherwise the class is scanned. Snapshots of classes patched by mocks
+    are not saved, other processes would load them after the mocks are
+    gone.
+
+    :param class_def: Class definition.
+    :param rescan: Scan the class even if it is cached on disk.
+    :return: Tuple of interface dict with FuncDef objects, list of
+            names of data attributes and flag whether the class is
+            patched by mocks.
+    """
+    is_patched = False
+    snapshot = None if rescan else iface_cache.load(class_def)
+    if snapshot is None:
+        snapshot, is_patched = _scan_class(class_def)
+        if not is_patched:
+            iface_cache.save(class_def, snapshot)
+
+    interface = {}
+    var_names = []
+
+    for name, kind, spec_key, is_async in snapshot:
+        if kind == 'property':
+            interface[name + '__get_prop'] = vmock_defs.FuncDef(
+                name=name, kind=kind, func=None,
                 arg_spec=vmock_defs.NO_ARGS_SPEC, owner=None)
-            interface[attr.name + '__set_prop'] = vmock_defs.FuncDef(
-                name=attr.name, kind=attr.kind, func=None,
+            interface[name + '__set_prop'] = vmock_defs.FuncDef(
+                name=name, kind=kind, func=None,
                 arg_spec=vmock_defs.VALUE_ARGS_SPEC, owner=None)
-            interface[attr.name + '__del_prop'] = vmock_defs.FuncDef(
-                name=attr.name, kind=attr.kind, func=None,
+            interface[name + '__del_prop'] = vmock_defs.FuncDef(
+                name=name, kind=kind, func=None,
                 arg_spec=vmock_defs.NO_ARGS_SPEC, owner=None)
-        elif attr.kind != 'data':
-            interface[attr.name] = func_def
+        elif kind == 'data':
+            var_names.append(name)
         else:
-            if not (attr.name.startswith('__') and attr.name.endswith('__')):
-                var_list.append(attr)
+            interface[name] = vmock_defs.FuncDef(
+                name=name, kind=kind, func=None,
+                arg_spec=vmock_defs.arg_spec_from_key(spec_key), owner=None,
+                is_async=is_async)
+
+    return interface, var_names, is_patched
 
-    init_list = [CLASS_TMPL.format(class_name)]
-    method_list = []
+
+def get_class_cache(class_def):
+    """Returns up to date cache entry of the class definition.
+
+    Class patched by mocks is scanned each time and is not cached, the
+    entry would outlive the mocks.
+    """
+    fingerprint = _class_fingerprint(class_def)
+    cache = _class_cache.get(class_def)
+    if cache is None or cache.fingerprint != fingerprint:
+        interface, var_names, is_patched = get_class_interface(
+            class_def, rescan=cache is not None)
+        cache = _ClassCache(fingerprint, interface, var_names)
+        if not is_patched:
+            _class_cache[class_def] = cache
+    return cache
+
+
+def invalidate(class_def):
+    """Scans the class again after its attribute was replaced in runtime.
+
+    Added and removed attributes are detected automatically. Fakes made
+    after the call mimic the new interface, on-disk cache entry of the
+    class is replaced too.
+
+    :param class_def: Class definition.
+    """
+    _class_cache.pop(class_def, None)
+    interface, var_names, is_patched = get_class_interface(class_def,
+                                                           rescan=True)
+    if not is_patched:
+        _class_cache[class_def] = _ClassCache(
+            _class_fingerprint(class_def), interface, var_names)
+
+
+def _make_fake_class(class_name, interface):
+    """Generates fake class source and executes it."""
+    code_list = [CLASS_TMPL.format(class_name)]
 
     for name, func_def in interface.items():
         if func_def.kind == 'property':
             if name.endswith('__get_prop'):
-                init_list.append(TMPL_MOCKER_PROP.format(func_def.name))
-                method_list.append(PROP_TMPL.format(func_def.name))
-        elif func_def.kind == 'data':
-            var_list.append(func_def)
+                code_list.append(PROP_TMPL.format(func_def.name))
         else:
-            method_list.append(METHOD_TMPL.format(name))
+            code_list.append(METHOD_TMPL.format(name))
 
-    init_list.extend(method_list)
-    code = '\n'.join(init_list)
+    code = '\n'.join(code_list)
 
     class_module = types.ModuleType('')
+    class_module._vmock_method = MethodAttribute
     exec(code, class_module.__dict__)
-    return class_module.__dict__[class_name](mc, var_list, interface, mocker)
+    return class_module.__dict__[class_name]
+
+
+def init_fake_class(mc, class_def, class_name, is_stub):
+    """Initializes fake class.
+
+    Generated fake classes are cached per class definition, so only the
+    first call for the class does the scan and code generation.
+
+    :param MockControl mc: Mockcontrol instance.
+    :param class_def: Class definition to mock.
+    :param class_name: Class name.
+    :param is_stub: If True makes method stubs.
+    """
+
+    if is_stub:
+        mocker = methodmock.new_stub
+    else:
+        mocker = methodmock.new_mock
 
+    cache = get_class_cache(class_def)
+    fake_key = (vmock_defs.ENGINE_SOURCE, is_stub, class_name)
+    fake_class = cache.fake_classes.get(fake_key)
+    if fake_class is None:
+        fake_class = _make_fake_class(class_name, cache.interface)
+        cache.fake_classes[fake_key] = fake_class
 
+    var_list = get_var_list(class_def, cache.var_names)
+    return fake_class(mc, var_list, cache.interface, mocker)
@@ -0,0 +1,116 @@
+"""Fake class builder based on mock descriptors.
+
+Unlike mock_src_gen it doesn't generate source code, fake class is made
+by type() call with one small descriptor per class attribute. Mocks are
+created on first attribute access, so it works for classes with
+thousands of methods and for attribute names that are not valid
+identifiers.
+"""
+
+from vmock import methodmock
+from vmock import vmock_defs
+from vmock import mock_src_gen
+
+
+class FakeObject(object):
+
+    """Base class of fake objects made by descriptors."""
+
+    def __init__(self, mc, var_list, interface, mocker):
+        self.__mc = mc
+        self.__mocker = mocker
+        self.__interface = interface
+        self.__m = dict()
+        for name, value in var_list:
+            setattr(self, name, value)
+            setattr(self.__class__, name, value)
+
+    def _vmock_get_mock(self, name, display_name):
+        """Returns mock of the attribute, creates it if needed."""
+        mock = self.__m.get(name)
+        if mock is None:
+            mock = self.__mocker(self.__interface[name], self.__mc,
+                                 display_name)
+            self.__m[name] = mock
+        return mock
+
+
+class MethodDescriptor(object):
+
+    """Non-data descriptor that returns method mock.
+
+    Mock is saved in the instance dict, so next attribute access doesn't
+    call the descriptor. Special methods are looked up in the class,
+    they always get the mock through the descriptor.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        mock = instance._vmock_get_mock(self.name, None)
+        instance.__dict__[self.name] = mock
+        return mock
+
+
+class PropertyDescriptor(object):
+
+    """Data descriptor that forwards property access to its mocks."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._vmock_get_mock(self.name + '__get_prop',
+                                        'get_' + self.name)()
+
+    def __set__(self, instance, value):
+        instance._vmock_get_mock(self.name + '__set_prop',
+                                 'set_' + self.name)(value)
+
+    def __delete__(self, instance):
+        instance._vmock_get_mock(self.name + '__del_prop',
+                                 'del_' + self.name)()
+
+
+def _make_fake_type(class_name, interface):
+    """Makes fake class with descriptors for all interface attributes."""
+    namespace = {}
+    for name, func_def in interface.items():
+        if func_def.kind == 'property':
+            namespace[func_def.name] = PropertyDescriptor(func_def.name)
+        else:
+            namespace[name] = MethodDescriptor(name)
+    return type(class_name, (FakeObject,), namespace)
+
+
+def init_fake_type(mc, class_def, class_name, is_stub):
+    """Initializes fake object made of mock descriptors.
+
+    :param MockControl mc: Mockcontrol instance.
+    :param class_def: Class definition to mock.
+    :param class_name: Class name.
+    :param is_stub: If True makes method stubs.
+    """
+    if is_stub:
+        mocker = methodmock.new_stub
+    else:
+        mocker = methodmock.new_mock
+
+    cache = mock_src_gen.get_class_cache(class_def)
+    fake_key = (vmock_defs.ENGINE_DESCRIPTOR, is_stub, class_name)
+    fake_class = cache.fake_classes.get(fake_key)
+    if fake_class is None:
+        fake_class = _make_fake_type(class_name, cache.interface)
+        cache.fake_classes[fake_key] = fake_class
+
+    var_list = mock_src_gen.get_var_list(class_def, cache.var_names)
+    return fake_class(mc, var_list, cache.interface, mocker)
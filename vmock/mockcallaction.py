@@ -1,8 +1,15 @@
 """MockCallAction class to store call data.
 """
 # pylint: disable=raising-bad-type
+import itertools
+import threading
+from collections.abc import Iterator
+
 from vmock import matchers
 from vmock import mockerrors
+from vmock.actionindex import make_key
+from vmock.payload import FilePayload
+from vmock.streams import AsyncStream
 
 
 class MockCallResult:
@@ -11,6 +18,97 @@ class MockCallResult:
     RETURN_VALUE = 1
     RAISE_EXCEPTION = 2
     EXECUTE_FUNCTION = 3
+    RETURN_FROM = 4
+    RETURN_CYCLE = 5
+    RETURN_FILE = 6
+    RETURN_ASYNC_ITER = 7
+
+
+# Action flags are packed into one int together with the result type.
+_RESULT_TYPE_MASK = 0x0F
+_RAISE_CALL_ERROR = 0x10
+_NON_ORDERED = 0x20
+_ANY_ARGS = 0x40
+# Parent MockControl tracks number of calls of this action.
+_TRACKED = 0x80
+# Parent MockControl is told about the next call, a savepoint keeps
+# the current call counter.
+_WATCHED = 0x100
+# Flags that belong to the parent MockControl state.
+_CONTROL_FLAGS = _TRACKED | _WATCHED
+
+
+class _Replayable(object):
+
+    """Iterable that repeats values taken from an iterator.
+
+    Values are taken from the iterator lazily and kept, so each iteration
+    starts from the first value like iteration of a list. It is used for
+    cycles only, they need values of the first pass anyway.
+    """
+
+    __slots__ = ('source', 'values', 'lock')
+
+    def __init__(self, source):
+        self.source = source
+        self.values = []
+        # Iterations of action copies may run in many threads.
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        values = self.values
+        i = 0
+        while True:
+            if i >= len(values):
+                with self.lock:
+                    if i >= len(values):
+                        try:
+                            values.append(next(self.source))
+                        except StopIteration:
+                            return
+            yield values[i]
+            i += 1
+
+
+class _Restartable(object):
+
+    """Iterable made by a function that returns new iterable each time."""
+
+    __slots__ = ('factory',)
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __iter__(self):
+        return iter(self.factory())
+
+
+def _values_source(iterable, is_cycle):
+    """Returns source of values of returns_from or returns_cycle result.
+
+    Function without __iter__, such as generator function, is called to
+    start values again after rollback and in action copies. Values of
+    iterators are kept only for cycles.
+    """
+    if callable(iterable) and not hasattr(iterable, '__iter__'):
+        return _Restartable(iterable)
+    if is_cycle and isinstance(iterable, Iterator):
+        return _Replayable(iterable)
+    return iterable
+
+
+def _cycle(iterable):
+    """Repeats values of the iterable, stops if a pass is empty.
+
+    Iterable is iterated again on each pass, so values are not kept.
+    """
+    while True:
+        empty = True
+        for value in iterable:
+            empty = False
+            yield value
+        if empty:
+            return
 
 
 class MockCallAction(object):
@@ -20,6 +118,10 @@ class MockCallAction(object):
     on call, raise exception or call custom function.
     """
 
+    __slots__ = ('__obj', '__args', '__kwargs', '__calls_counter',
+                 '__max_times', '__min_times', '__flags', '__return_value',
+                 '__key', '__matchers', '__values', '__seq')
+
     def __init__(self, obj, args, kwargs):
         """Constructor.
 
@@ -34,14 +136,67 @@ class MockCallAction(object):
         self.__calls_counter = 0
         self.__max_times = 1
         self.__min_times = 1
-        self.__result_type = MockCallResult.RETURN_VALUE
+        # Result type and flags. _RAISE_CALL_ERROR may be used for debug
+        # purpose if it is difficult to find a source of error.
+        self.__flags = MockCallResult.RETURN_VALUE
         self.__return_value = None
+        # Iterator of values of RETURN_FROM and RETURN_CYCLE results.
+        self.__values = None
+        # Tracking number given by MockControl, orders verify errors.
+        self.__seq = 0
 
-        # May be used for debug purpose if it is difficult to find
-        # a source of error.
+        self.__compile_args()
 
-        self.__raise_call_error = False
-        self.__non_ordered = False
+    def __compile_args(self):
+        """Prepares expected arguments for fast comparison.
+
+        Lookup key is set for hashable arguments without matchers. If there
+        are matchers, their positions are saved, so the rest of arguments
+        are compared by value.
+        """
+        args = self.__args
+        kwargs = self.__kwargs
+        self.__key = make_key(args, kwargs)
+        self.__matchers = None
+
+        if len(args) == 1 and isinstance(args[0], matchers.AnyArgsMatcher):
+            self.__flags |= _ANY_ARGS
+            return
+        if self.__key is not None:
+            return
+
+        arg_pos = tuple(i for i, val in enumerate(args)
+                        if isinstance(val, matchers.MockMatcher))
+        kw_names = tuple(k for k, val in kwargs.items()
+                         if isinstance(val, matchers.MockMatcher))
+        if arg_pos or kw_names:
+            exact_pos = tuple(i for i in range(len(args))
+                              if i not in arg_pos)
+            exact_names = tuple(k for k in kwargs if k not in kw_names)
+            self.__matchers = (exact_pos, arg_pos, exact_names, kw_names)
+
+    def __set_result(self, result_type, value):
+        """Sets result type keeping the flags."""
+        self.__flags = (self.__flags & ~_RESULT_TYPE_MASK) | result_type
+        self.__return_value = value
+        self.__values = None
+
+    def __make_values(self):
+        """Makes new iterator of RETURN_FROM or RETURN_CYCLE values."""
+        if self.__flags & _RESULT_TYPE_MASK == MockCallResult.RETURN_FROM:
+            return iter(self.__return_value)
+        return _cycle(self.__return_value)
+
+    def __next_value(self):
+        """Returns next value of RETURN_FROM or RETURN_CYCLE result."""
+        values = self.__values
+        if values is None:
+            values = self.__values = self.__make_values()
+        for value in values:
+            return value
+        self.__obj._mc.raise_error(mockerrors.CallsNumberError(
+            '%s - Values are exhausted after %d calls' %
+            (self, self.__calls_counter - 1)))
 
     def __str__(self):
         return '%s, with args: %s' % \
@@ -58,6 +213,147 @@ class MockCallAction(object):
                                                           self.__min_times)
         return None
 
+    def _is_below_min(self):
+        """Check if action is called less than minimum number of times."""
+        return self.__min_times > 0 and self.__calls_counter < self.__min_times
+
+    def _is_over_max(self):
+        """Check if action is called more than maximum number of times."""
+        return self.__max_times > 0 and self.__calls_counter > self.__max_times
+
+    def _copy(self, obj, args=None, kwargs=None, result=None):
+        """Makes a copy of the action for another mock.
+
+        Copy shares expected arguments, compiled matchers and result with
+        this action. Its call counter is 0 and it is not tracked.
+
+        :param obj: Parent MethodMock object of the copy.
+        :param args: New expected args, if given they are compiled again.
+        :param kwargs: New expected keyword args, used together with args.
+        :param result: New (result type, value) pair.
+        """
+        new = MockCallAction.__new__(MockCallAction)
+        new.__obj = obj
+        new.__args = self.__args
+        new.__kwargs = self.__kwargs
+        new.__calls_counter = 0
+        new.__max_times = self.__max_times
+        new.__min_times = self.__min_times
+        new.__flags = self.__flags & ~_CONTROL_FLAGS
+        new.__return_value = self.__return_value
+        new.__key = self.__key
+        new.__matchers = self.__matchers
+        new.__values = None
+        new.__seq = 0
+        if args is not None:
+            new.__args = args
+            new.__kwargs = kwargs
+            new.__flags &= ~_ANY_ARGS
+            new.__compile_args()
+        if result is not None:
+            new.__set_result(*result)
+        return new
+
+    @staticmethod
+    def _table_row(obj, args, kwargs, value):
+        """Makes non-ordered action that returns the value any times.
+
+        It is the same as MockCallAction(obj, args, kwargs).returns(value)
+        .anyorder(), used to add large tables of actions.
+        """
+        action = MockCallAction.__new__(MockCallAction)
+        action.__obj = obj
+        action.__args = args
+        action.__kwargs = kwargs
+        action.__calls_counter = 0
+        action.__max_times = 0
+        action.__min_times = 0
+        action.__flags = MockCallResult.RETURN_VALUE | _NON_ORDERED
+        action.__return_value = value
+        action.__values = None
+        action.__seq = 0
+        action.__compile_args()
+        return action
+
+    @staticmethod
+    def _table_row_state(args, kwargs, value):
+        """Returns state of _table_row action without making it."""
+        return (args, kwargs, 0, 0, MockCallResult.RETURN_VALUE | _NON_ORDERED,
+                value)
+
+    def _get_state(self):
+        """Returns action state without parent mock, used to save it."""
+        return (self.__args, self.__kwargs, self.__min_times,
+                self.__max_times, self.__flags & ~_CONTROL_FLAGS,
+                self.__return_value)
+
+    @staticmethod
+    def _from_state(obj, state):
+        """Makes action of the mock back from its state.
+
+        :param obj: Parent MethodMock object.
+        :param state: Result of _get_state call.
+        """
+        args, kwargs, min_times, max_times, flags, return_value = state
+        action = MockCallAction(obj, args, kwargs)
+        action.__min_times = min_times
+        action.__max_times = max_times
+        action.__flags = flags
+        action.__return_value = return_value
+        return action
+
+    @property
+    def result(self):
+        """Expected result as (MockCallResult type, value) pair."""
+        return self.__flags & _RESULT_TYPE_MASK, self.__return_value
+
+    @property
+    def calls_counter(self):
+        """Number of calls of this action."""
+        return self.__calls_counter
+
+    def _set_calls_counter(self, counter):
+        """Sets number of calls, used to roll back recorded state.
+
+        Values of the result are taken again from the start, the values
+        returned by restored calls are skipped. Iterators can not be
+        started again, they go on from the current value.
+        """
+        self.__calls_counter = counter
+        if (self.has_shared_state and
+                not isinstance(self.__return_value, Iterator)):
+            self.__values = None
+            if counter:
+                values = self.__values = self.__make_values()
+                for _ in itertools.islice(values, counter):
+                    pass
+        self.__call_state_changed()
+
+    def _set_watched(self):
+        """Makes the next call reported to MockControl."""
+        self.__flags |= _WATCHED
+
+    def _set_tracked(self, tracked, seq=0):
+        """Enables or disables reporting of call state to MockControl.
+
+        :param seq: Tracking number, the first one given is kept.
+        """
+        if tracked:
+            self.__flags |= _TRACKED
+            if not self.__seq:
+                self.__seq = seq
+        else:
+            self.__flags &= ~_TRACKED
+
+    def _get_seq(self):
+        """Returns tracking number of the action, 0 if it was not tracked."""
+        return self.__seq
+
+    def __call_state_changed(self):
+        """Reports changed call counter or limits to MockControl."""
+        if self.__flags & _TRACKED:
+            self.__obj._mc._update_call_state(self)
+
     def _is_times_limit(self):
         """Check if number of calls reached its limit.
 
@@ -70,16 +366,46 @@ class MockCallAction(object):
 
         Each result getter call increases call counter.
         """
-        self.__calls_counter += 1
-        if self.__raise_call_error:
+        self._count_call()
+        return self._make_result(args, kwargs)
+
+    def _count_call(self):
+        """Increases call counter and reports call state to MockControl."""
+        counter = self.__calls_counter = self.__calls_counter + 1
+        flags = self.__flags
+        if flags & _WATCHED:
+            self.__flags = flags = flags & ~_WATCHED
+            self.__obj._mc._action_called(self)
+        elif counter == 1:
+            self.__obj._mc._action_called(self)
+        if flags & _TRACKED:
+            if counter == self.__min_times or counter == self.__max_times + 1:
+                self.__obj._mc._update_call_state(self)
+        if flags & _RAISE_CALL_ERROR:
             self.obj._mc.raise_error(
                 mockerrors.UnexpectedCall('Unexpected call caught!'))
-        if self.__result_type == MockCallResult.RETURN_VALUE:
+
+    def _make_result(self, args, kwargs):
+        """Does/Returns recorded result without counting the call."""
+        result_type = self.__flags & _RESULT_TYPE_MASK
+        if result_type == MockCallResult.RETURN_VALUE:
             return self.__return_value
-        elif self.__result_type == MockCallResult.RAISE_EXCEPTION:
+        elif result_type == MockCallResult.RAISE_EXCEPTION:
             raise self.__return_value
-        elif self.__result_type == MockCallResult.EXECUTE_FUNCTION:
+        elif result_type == MockCallResult.EXECUTE_FUNCTION:
             return self.__return_value(*args, **kwargs)
+        elif result_type == MockCallResult.RETURN_FILE:
+            return self.__obj._mc.file_view(self.__return_value)
+        elif result_type == MockCallResult.RETURN_ASYNC_ITER:
+            return self.__return_value.open(self.__obj._mc.clock)
+        else:
+            return self.__next_value()
+
+    @property
+    def has_shared_state(self):
+        """True if result has state changed by calls, such as iterator."""
+        return (self.__flags & _RESULT_TYPE_MASK) in (
+            MockCallResult.RETURN_FROM, MockCallResult.RETURN_CYCLE)
 
     @property
     def args(self):
@@ -99,47 +425,90 @@ class MockCallAction(object):
     @property
     def is_ordered(self):
         """Returns True if MockCall expected to be a non-ordered"""
-        return self.__non_ordered
+        return bool(self.__flags & _NON_ORDERED)
+
+    @property
+    def lookup_key(self):
+        """Hashable key of expected arguments or None if there is no key."""
+        return self.__key
+
+    # ActionIndex entry methods, see ActionIndex.
+
+    def _entry_actions(self):
+        return (self,)
+
+    _made_actions = _entry_actions
+
+    def _entry_states(self):
+        return (self._get_state(),)
+
+    def _entry_find(self, args, kwargs, key=None):
+        return self if self._compare_args(args, kwargs) else None
+
+    def _entry_accepted(self, action):
+        if action._compare_args(self.__args, self.__kwargs):
+            return self
+        return None
+
+    def _entry_has_key(self, key):
+        if self.__flags & _ANY_ARGS:
+            return True
+        return self.__args == key[0] and self.__kwargs == dict(key[1])
+
+    def _entry_has_any_key(self, keys):
+        if self.__flags & _ANY_ARGS:
+            return bool(keys)
+        return any(self._entry_has_key(key) for key in keys)
 
     def _compare_args(self, args, kwargs):
         """Compares external call arguments with CallAction arguments"""
 
         # Check if there are any arguments matcher.
-        if (self.args and len(self.args) == 1 and
-                isinstance(self.args[0], matchers.AnyArgsMatcher)):
+        if self.__flags & _ANY_ARGS:
             return True
 
         # Check if there are any arguments matcher.
-        if (args and len(args) == 1 and
-                isinstance(args[0], matchers.AnyArgsMatcher)):
+        if len(args) == 1 and isinstance(args[0], matchers.AnyArgsMatcher):
             return True
 
+        compiled = self.__matchers
+        if compiled is None:
+            return self.__args == args and self.__kwargs == kwargs
+
+        e_args = self.__args
+        e_kwargs = self.__kwargs
         # Make sure that length of expected args is equal to actual args.
-        if len(self.args) != len(args) or len(self.kwargs) != len(kwargs):
+        if len(e_args) != len(args) or len(e_kwargs) != len(kwargs):
             return False
 
         # Verify difference between kwargs keys.
-        if bool(set(self.kwargs.keys()).difference(set(kwargs.keys()))):
+        if kwargs and e_kwargs.keys() != kwargs.keys():
             return False
 
-        # Verify call args including matchers.
-        for e_arg, a_arg in zip(self.args, args):
-            if not self.__compare_values(e_arg, a_arg):
+        exact_pos, arg_pos, exact_names, kw_names = compiled
+        for i in exact_pos:
+            if not e_args[i] == args[i]:
+                return False
+        for key in exact_names:
+            if not e_kwargs[key] == kwargs[key]:
                 return False
 
-        for key in kwargs.keys():
-            if not self.__compare_values(self.kwargs[key], kwargs[key]):
+        # Verify call args including matchers.
+        for i in arg_pos:
+            if not self.__compare_matcher(e_args[i], args[i]):
+                return False
+        for key in kw_names:
+            if not self.__compare_matcher(e_kwargs[key], kwargs[key]):
                 return False
 
         return True
 
-    def __compare_values(self, e_val, a_val):
-        """Compare call values, it take into consideration matchers."""
-        if (isinstance(e_val, matchers.MockMatcher) and
-                not isinstance(a_val, matchers.MockMatcher)):
-            return e_val.compare(a_val)
-        else:
-            return e_val == a_val
+    @staticmethod
+    def __compare_matcher(matcher, a_val):
+        """Compare call value with matcher."""
+        if isinstance(a_val, matchers.MockMatcher):
+            return matcher == a_val
+        return matcher.compare(a_val)
 
     def mintimes(self, times):
         """Set minimum number of method mock calls. Must be non-ordered.
@@ -150,6 +519,7 @@ class MockCallAction(object):
         if self.__max_times > 0 and times > self.__max_times:
             raise ValueError('Min number of calls can not be greater than max')
         self.__min_times = times
+        self.__call_state_changed()
         return self
 
     def maxtimes(self, times):
@@ -163,6 +533,7 @@ class MockCallAction(object):
         if self.__min_times > 0 and times < self.__min_times:
             raise ValueError('MZ number of calls can not be less than min')
         self.__max_times = times
+        self.__call_state_changed()
         return self
 
     def anyorder(self):
@@ -170,7 +541,7 @@ class MockCallAction(object):
 
         Non-ordered may be called any times by default.
         """
-        self.__non_ordered = True
+        self.__flags |= _NON_ORDERED
         self.anytimes()
         return self
 
@@ -191,6 +562,7 @@ class MockCallAction(object):
             raise ValueError('Times must be > 0')
         self.__max_times = times
         self.__min_times = times
+        self.__call_state_changed()
         return self
 
     def anytimes(self):
@@ -199,6 +571,7 @@ class MockCallAction(object):
             raise ValueError('Must be non-ordered to call any times')
         self.__max_times = 0
         self.__min_times = 0
+        self.__call_state_changed()
         return self
 
     def raise_debug_call(self):
@@ -206,7 +579,7 @@ class MockCallAction(object):
 
         Use it for debug purposes if you are not sure in test failure point.
         """
-        self.__raise_call_error = True
+        self.__flags |= _RAISE_CALL_ERROR
         return self
 
     def returns(self, val):
@@ -214,8 +587,7 @@ class MockCallAction(object):
 
         :param val: Value to return.
         """
-        self.__result_type = MockCallResult.RETURN_VALUE
-        self.__return_value = val
+        self.__set_result(MockCallResult.RETURN_VALUE, val)
         return self
 
     def raises(self, exc):
@@ -223,8 +595,69 @@ class MockCallAction(object):
 
         :param exc: Instance of exception that should be raised.
         """
-        self.__result_type = MockCallResult.RAISE_EXCEPTION
-        self.__return_value = exc
+        self.__set_result(MockCallResult.RAISE_EXCEPTION, exc)
+        return self
+
+    def returns_from(self, iterable):
+        """Return next value of the iterable on each call.
+
+        Values are taken lazily and are not kept, so the iterable may be
+        a generator of any length. When values are exhausted the call
+        fails with CallsNumberError that is also raised by verify().
+        Iterators and generators are iterated once, rollback does not
+        start them again and action copies made by templates share them.
+        Pass a function returning new iterable, such as a generator
+        function, to start values again.
+
+        :param iterable: Iterable of values to return or function without
+                arguments returning it.
+        """
+        self.__set_result(MockCallResult.RETURN_FROM,
+                          _values_source(iterable, False))
+        return self
+
+    def returns_cycle(self, iterable):
+        """Return values of the iterable in cycle.
+
+        Iterable is iterated again after the last value, values of
+        iterators and generators are kept for the next passes.
+
+        :param iterable: Iterable of values to return or function without
+                arguments returning it.
+        """
+        self.__set_result(MockCallResult.RETURN_CYCLE,
+                          _values_source(iterable, True))
+        return self
+
+    def returns_file(self, path, offset=0, length=None):
+        """Return contents of the file as a read-only memoryview.
+
+        File is mapped to memory on the first call and all calls share
+        the same view, so large payloads are not copied. Empty range
+        returns empty memoryview.
+
+        :param path: File path.
+        :param offset: Start of the payload in the file.
+        :param length: Length of the payload, the rest of the file if None.
+        """
+        self.__set_result(MockCallResult.RETURN_FILE,
+                          FilePayload(path, offset, length))
+        return self
+
+    def returns_async_iter(self, iterable, chunk_size=None, delay=None):
+        """Return new async iterator over the iterable on each call.
+
+        Items are taken lazily from sync or async iterable, so streams of
+        any length can be used in 'async for' loops.
+
+        :param iterable: Sync or async iterable of items.
+        :param chunk_size: Yield lists of up to chunk_size items. Bytes
+                and strings are split into slices of chunk_size length.
+        :param delay: Seconds of virtual time before each item, the virtual
+                clock is advanced if it is installed.
+        """
+        self.__set_result(MockCallResult.RETURN_ASYNC_ITER,
+                          AsyncStream(iterable, chunk_size, delay))
         return self
 
     def does(self, func):
@@ -236,6 +669,5 @@ class MockCallAction(object):
 
         :param func: Function that will be called.
         """
-        self.__result_type = MockCallResult.EXECUTE_FUNCTION
-        self.__return_value = func
+        self.__set_result(MockCallResult.EXECUTE_FUNCTION, func)
         return self
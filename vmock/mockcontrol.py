@@ -2,21 +2,83 @@
 """
 # pylint: disable=raising-bad-type
 
+import asyncio
+import contextlib
 import inspect
+import itertools
+import threading
+import time
 import types
+from collections import namedtuple
+from collections.abc import Mapping
 
 from vmock.methodmock import MethodMock, MethodStub
+from vmock.methodmock import new_mock, new_stub
 from vmock.mockcallaction import MockCallAction
 from vmock.mockerrors import CallSequenceError
 from vmock.mockerrors import CallsNumberError
 from vmock.mockerrors import MockError
+from vmock.mockerrors import UnexpectedCall
 
+from vmock import matchers
 from vmock import mock_src_gen
+from vmock import mock_type_gen
+from vmock.actionindex import ActionIndex
+from vmock.actionindex import ActionTable
+from vmock.actionindex import make_table_rows
+from vmock.clock import VirtualClock
+from vmock.template import ExpectationTemplate
+from vmock.template import MockDef
+from vmock.template import make_action_def
 from vmock.vmock_defs import ANY_ARGS_SPEC
+from vmock.vmock_defs import ENGINE_DESCRIPTOR
+from vmock.vmock_defs import ENGINE_SOURCE
 from vmock.vmock_defs import FuncDef
 from vmock.vmock_defs import NOT_MOCKABLE_METHODS
 
 
+# Undo journal entry kinds.
+_LOG_EXPECTATION = 1
+_LOG_STUB = 2
+_LOG_STATIC_STUB = 3
+_LOG_STATIC_REDEFINE = 4
+_LOG_MOCK = 5
+_LOG_CLOCK = 6
+
+_MISSING = object()
+
+# Number of locks guarding call counters in thread-safe replay mode.
+_LOCK_STRIPES = 64
+
+
+class _AttributePatch(object):
+
+    """Plain attribute value set by MockControl, restored like mocks.
+
+    It is used where calls must not go through a mock, the patched value
+    never raises errors saved by MockControl.
+    """
+
+    __slots__ = ('owner', 'name', 'original')
+
+    def __init__(self, owner, name, value):
+        self.owner = owner
+        self.name = name
+        # Value from the owner's own dict, inherited ones are not copied.
+        self.original = vars(owner).get(name, _MISSING)
+        setattr(owner, name, value)
+
+    def _restore_original(self):
+        if self.original is _MISSING:
+            delattr(self.owner, self.name)
+        else:
+            setattr(self.owner, self.name, self.original)
+
+
+Savepoint = namedtuple('Savepoint', ['journal', 'journal_size',
+                                     'called_size', 'counters'])
+
+
 class MockControl(object):
 
     """This class creates mock objects such as class objects,
@@ -25,15 +87,50 @@ class MockControl(object):
     back at the end.
     """
 
-    def __init__(self):
+    def __init__(self, engine=ENGINE_SOURCE):
+        """Constructor.
+
+        :param engine: Fake class engine used by mock_class/stub_class,
+                ENGINE_SOURCE or ENGINE_DESCRIPTOR.
+        """
+        if engine not in (ENGINE_SOURCE, ENGINE_DESCRIPTOR):
+            raise ValueError('Unknown fake class engine: %s' % (engine,))
+        self.__engine = engine
+        self.__object_mocks = {}
+        # File payloads mapped by calls, they are closed by tear_down.
+        self.__payloads = []
+        self.__init_records()
+
+        # Undo journal of recorded changes, it is created by savepoint().
+        self.__journal = None
+        # Actions called while savepoints exist, in order of their calls.
+        self.__called = []
+
+    def __init_records(self):
+        """Sets empty recorded state in record mode."""
         self.__exp_queue = []
+        # Expected ordered calls of each method mock, used to find duplicates.
+        self.__exp_index = {}
         self.__stubs = {}
         self.__static_stubs = {}
-        self.__object_mocks = {}
+        # Virtual clock installed by virtual_clock().
+        self.__clock = None
+        # Tracked non-ordered actions with too few and too many calls.
+        # Dicts are used as ordered sets.
+        self.__below_min = {}
+        self.__over_max = {}
+        # Last tracking number given to an action.
+        self.__track_seq = 0
         self.__record = True
         self.__play_pointer = 0
         self.__current_action = None
         self.__error = None
+        # Replay dispatch tables, see replay().
+        self.__replay_stubs = {}
+        self.__replay_queue = ()
+        # Locks of thread-safe replay mode.
+        self.__call_locks = None
+        self.__queue_lock = None
 
     def mock_constructor(self, module, class_name,
                          arg_spec=None, display_name=None):
@@ -220,10 +317,64 @@ class MockControl(object):
         return self.stub_method(fsc, 'stub', arg_spec=arg_spec,
                                 display_name=display_name)
 
-    def replay(self):
-        """Switches from recording to replay mode."""
+    def virtual_clock(self, start=None):
+        """Stubs time module functions with a virtual clock.
+
+        time.time, time.monotonic, time.perf_counter and time.sleep are
+        stubbed together, so sleep advances all of them instantly.
+        asyncio.sleep advances the clock and only yields to the event loop.
+        Event loops keep the real monotonic time for their timers, so
+        call_later and wait_for timeouts are not frozen by the clock. Loop
+        time is patched without a mock, errors saved by MockControl never
+        break event loops. Stubs are restored by tear_down like other
+        stubs.
+
+        :param start: Initial value of time.time(), current time if None.
+        :return: VirtualClock object.
+        """
+        if not self.__record:
+            raise MockError('Virtual clock can be installed in record '
+                            'mode only')
+
+        loop_time = time.monotonic
+        clock = VirtualClock(start)
+        for name in VirtualClock.FUNCTIONS:
+            stub = self.stub_method(time, name)
+            stub(matchers.any_args()).does(getattr(clock, name))
+        stub = self.stub_method(asyncio, 'sleep')
+        stub(matchers.any_args()).does(clock.async_sleep)
+        self.__patch_attribute(asyncio.BaseEventLoop, 'time', loop_time)
+        self.__log(_LOG_CLOCK, self.__clock)
+        self.__clock = clock
+        return clock
+
+    @property
+    def clock(self):
+        """Virtual clock installed by virtual_clock() or None."""
+        return self.__clock
+
+    def replay(self, thread_safe=False):
+        """Switches from recording to replay mode.
+
+        Recorded state is frozen into dispatch tables used by
+        get_call_action: stub finders of each mock and a tuple of ordered
+        expectations.
+
+        :param thread_safe: Allow mocks to be called by many threads.
+                Stubs are looked up without locks, call counters of
+                actions are guarded by striped locks. Ordered expectations
+                are taken under one lock, so they must be called in
+                strict global order.
+        """
         self._save_current_action()
         self.__record = False
+        self.__replay_stubs = {mock: stubs.find
+                               for mock, stubs in self.__stubs.items()}
+        self.__replay_queue = tuple(self.__exp_queue)
+        if thread_safe:
+            self.__call_locks = tuple(threading.Lock()
+                                      for _ in range(_LOCK_STRIPES))
+            self.__queue_lock = threading.Lock()
 
     def verify(self):
         """Do post execution verification."""
@@ -237,30 +388,207 @@ class MockControl(object):
                       'Current call is: ' + str(next_expected)
             raise CallSequenceError(err_txt)
 
-        # Verify stubs.
+        # Verify stubs. Only actions with wrong number of calls are tracked,
+        # so nothing is checked if all of them are fine.
+        if not self.__over_max and not self.__below_min:
+            return
+
+        # Errors are reported in order of registration: stubs before static
+        # stubs, grouped by mock, actions in order they were tracked.
+        mock_order = {obj: i for i, obj in enumerate(
+            itertools.chain(self.__stubs, self.__static_stubs))}
+        failed = sorted(itertools.chain(self.__over_max, self.__below_min),
+                        key=lambda a: (mock_order.get(a.obj, -1),
+                                       a._get_seq()))
         errors = []
-        for stub in self.__stubs.values():
-            for action in stub:
-                error_text = action.get_call_error()
-                if error_text:
-                    errors.append(str('%s - %s' % (str(action), error_text)))
-
-        # Verify static stubs.
-        for stub in self.__static_stubs.values():
-            for action in stub:
-                error_text = action.get_call_error()
-                if error_text:
-                    errors.append(str('%s - %s' % (str(action), error_text)))
+        for action in failed:
+            error_text = action.get_call_error()
+            if error_text:
+                errors.append(str('%s - %s' % (str(action), error_text)))
 
         if errors:
             raise CallsNumberError('\n'.join(errors))
 
     def tear_down(self):
-        """Restore all mocked function/method/classes back."""
+        """Restore all mocked function/method/classes back.
+
+        Files mapped by returns_file results are unmapped.
+        """
         for methods in self.__object_mocks.values():
             for method_data in methods.values():
                 if method_data is not None:
                     method_data._restore_original()
+        payloads, self.__payloads = self.__payloads, []
+        for payload in payloads:
+            payload.close()
+
+    def reset(self):
+        """Restores mocked objects and starts recording from scratch.
+
+        All recorded actions are released, so MockControl can be reused by
+        the next test. Generated fake classes and interface validators are
+        cached per process and are reused by new mocks.
+        """
+        self.tear_down()
+        self.__object_mocks = {}
+        self.__init_records()
+        self.__journal = None
+        self.__called = []
+
+    def savepoint(self):
+        """Makes a savepoint of recorded state to roll back to later.
+
+        Savepoint can be made in record mode only. After the first savepoint
+        all recorded changes are logged in the undo journal.
+
+        :return: Savepoint object for rollback().
+        """
+        assert self.__record, 'The play mode is set'
+        self._save_current_action()
+        self.__current_action = None
+        if self.__journal is None:
+            self.__journal = []
+        # Called actions report their next call, so rollback restores
+        # only counters changed after the savepoint.
+        counters = {}
+        for action in self.__recorded_actions():
+            counter = action.calls_counter
+            if counter:
+                counters[action] = counter
+                action._set_watched()
+        return Savepoint(journal=self.__journal,
+                         journal_size=len(self.__journal),
+                         called_size=len(self.__called),
+                         counters=counters)
+
+    def rollback(self, savepoint):
+        """Rolls recorded state back to the savepoint and switches to
+        record mode.
+
+        Expectations, stubs and mocks created after the savepoint are
+        dropped, mocked objects are restored and call counters get their
+        savepoint values. Other changes of actions recorded before the
+        savepoint, such as a new return value, are not rolled back.
+        Time of rollback depends only on the amount of changes.
+
+        :param savepoint: Result of savepoint() call.
+        """
+        journal = self.__journal
+        if (savepoint.journal is not journal or
+                savepoint.journal_size > len(journal)):
+            raise ValueError('Savepoint is not valid')
+
+        while len(journal) > savepoint.journal_size:
+            self.__undo(journal.pop())
+
+        for action in self.__called[savepoint.called_size:]:
+            counter = savepoint.counters.get(action, 0)
+            action._set_calls_counter(counter)
+            if counter:
+                action._set_watched()
+        del self.__called[savepoint.called_size:]
+
+        self.__record = True
+        self.__play_pointer = 0
+        self.__current_action = None
+        self.__error = None
+        self.__replay_stubs = {}
+        self.__replay_queue = ()
+        self.__call_locks = None
+        self.__queue_lock = None
+
+    @contextlib.contextmanager
+    def _atomic(self):
+        """Undoes recorded changes made in the block if it fails.
+
+        Changes are journaled during the block even without savepoints.
+        """
+        journal = self.__journal
+        if journal is None:
+            self.__journal = []
+        size = len(self.__journal)
+        try:
+            yield
+        except BaseException:
+            while len(self.__journal) > size:
+                self.__undo(self.__journal.pop())
+            raise
+        finally:
+            if journal is None:
+                self.__journal = None
+
+    def __log(self, *entry):
+        """Adds an entry to the undo journal if there are savepoints."""
+        if self.__journal is not None:
+            self.__journal.append(entry)
+
+    def __undo(self, entry):
+        """Undoes one journal entry."""
+        kind, obj = entry[0], entry[1]
+        if kind == _LOG_EXPECTATION:
+            self.__exp_queue.pop()
+            self.__pop_action(self.__exp_index, obj)
+        elif kind in (_LOG_STUB, _LOG_STATIC_STUB):
+            storage = (self.__stubs if kind == _LOG_STUB
+                       else self.__static_stubs)
+            self._untrack_action(self.__pop_action(storage, obj))
+        elif kind == _LOG_STATIC_REDEFINE:
+            for action in self.__static_stubs.pop(obj).made_actions():
+                self._untrack_action(action)
+            old_stubs = entry[2]
+            if old_stubs is not None:
+                self.__static_stubs[obj] = old_stubs
+                for action in old_stubs.made_actions():
+                    self._track_action(action)
+        elif kind == _LOG_CLOCK:
+            self.__clock = obj
+        elif kind == _LOG_MOCK:
+            name, prev_mock = entry[2], entry[3]
+            owner_mocks = self.__object_mocks[obj]
+            owner_mocks[name]._restore_original()
+            if prev_mock is _MISSING:
+                del owner_mocks[name]
+                if not owner_mocks:
+                    del self.__object_mocks[obj]
+            else:
+                owner_mocks[name] = prev_mock
+
+    @staticmethod
+    def __pop_action(storage, obj):
+        """Removes the last action of the mock from the storage."""
+        index = storage[obj]
+        action = index.pop()
+        if not len(index):
+            del storage[obj]
+        return action
+
+    def __recorded_actions(self):
+        """Iterates recorded actions, rows of tables that are not made are
+        skipped."""
+        yield from self.__exp_queue
+        for storage in (self.__stubs, self.__static_stubs):
+            for index in storage.values():
+                yield from index.made_actions()
+
+    def _action_called(self, action):
+        """Called by action on its first call and on the next call after
+        a savepoint."""
+        if self.__journal is not None:
+            self.__called.append(action)
+
+    def file_view(self, payload):
+        """Returns view of returns_file payload, maps the file if needed.
+
+        Mapped files are closed by tear_down.
+        """
+        if payload.is_mapped:
+            return payload.view()
+        try:
+            view = payload.view()
+        except (OSError, ValueError) as e:
+            self.raise_error(e)
+        self.__payloads.append(payload)
+        return view
 
     def raise_error(self, error):
         """Generated errors must be stored, otherwise if test code
@@ -292,17 +620,24 @@ class MockControl(object):
         static_action.anyorder().anytimes()
 
         # Check if there is no stubs already exists.
-        for action in self.__static_stubs.get(obj, []):
-            if static_action._compare_args(action.args, action.kwargs):
-                raise ValueError('Static stub already exists!')
-
-        # Create container for MethodMock stubs.
-        if obj not in self.__static_stubs:
-            self.__static_stubs[obj] = []
+        static_stubs = self.__static_stubs.get(obj)
+        if (static_stubs is not None and
+                static_stubs.find_duplicate(static_action) is not None):
+            raise ValueError('Static stub already exists!')
 
-        self.__static_stubs[obj].append(static_action)
+        self.__store_static_action(static_action)
         return static_action
 
+    def __store_static_action(self, static_action):
+        """Adds checked static action to the static stubs of its mock."""
+        obj = static_action.obj
+        static_stubs = self.__static_stubs.get(obj)
+        if static_stubs is None:
+            static_stubs = self.__static_stubs[obj] = ActionIndex()
+        static_stubs.add(static_action)
+        self._track_action(static_action)
+        self.__log(_LOG_STATIC_STUB, obj)
+
     def redefine_static_action(self, obj, args, kwargs):
         """Redefines static action for the stub.
         """
@@ -313,40 +648,202 @@ class MockControl(object):
         # Default static action can be called any times times.
         static_action.anyorder().anytimes()
 
-        self.__static_stubs[obj] = [static_action]
+        old_stubs = self.__static_stubs.get(obj)
+        if old_stubs is not None:
+            for action in old_stubs.made_actions():
+                self._untrack_action(action)
+        self.__static_stubs[obj] = ActionIndex()
+        self.__static_stubs[obj].add(static_action)
+        self._track_action(static_action)
+        self.__log(_LOG_STATIC_REDEFINE, obj, old_stubs)
         return static_action
 
+    def _track_action(self, action):
+        """Starts tracking number of calls of non-ordered action."""
+        self.__track_seq += 1
+        action._set_tracked(True, self.__track_seq)
+        self._update_call_state(action)
+
+    def _untrack_action(self, action):
+        """Stops tracking number of calls of the action."""
+        action._set_tracked(False)
+        self.__below_min.pop(action, None)
+        self.__over_max.pop(action, None)
+
+    def _update_call_state(self, action):
+        """Updates sets of actions with wrong number of calls.
+
+        Tracked actions call it when their call counter or limits change.
+        """
+        if action._is_below_min():
+            self.__below_min[action] = None
+        else:
+            self.__below_min.pop(action, None)
+        if action._is_over_max():
+            self.__over_max[action] = None
+        else:
+            self.__over_max.pop(action, None)
+
     def is_recording(self):
         """Check if we are in recording mode."""
         return self.__record
 
     def find_stub(self, mock_obj, args, kwargs):
         """Find existing stub and increase call counter."""
-        for action in self.__stubs.get(mock_obj, []):
-            if action._compare_args(args, kwargs):
-                return action
-        return None
+        stubs = self.__stubs.get(mock_obj)
+        if stubs is None:
+            return None
+        return stubs.find(args, kwargs)
 
     def find_static_mock(self, mock_obj, args, kwargs):
         """Find existing stub and increase call counter."""
-        for action in self.__static_stubs.get(mock_obj, []):
-            if action._compare_args(args, kwargs):
-                return action
-        return None
+        static_stubs = self.__static_stubs.get(mock_obj)
+        if static_stubs is None:
+            return None
+        return static_stubs.find(args, kwargs)
 
     def pop_current_record(self):
         """Pop next record from the expectation queue."""
         assert not self.__record, "MockControl is still in record mode"
-        try:
-            if self.__play_pointer > 0:
-                exp_call = self.__exp_queue[self.__play_pointer - 1]
-                if not exp_call._is_times_limit():
-                    return exp_call
-
-            self.__play_pointer += 1
-            return self.__exp_queue[self.__play_pointer - 1]
-        except IndexError:
-            return None
+        queue = self.__replay_queue
+        pointer = self.__play_pointer
+        if 0 < pointer <= len(queue):
+            exp_call = queue[pointer - 1]
+            if not exp_call._is_times_limit():
+                return exp_call
+
+        self.__play_pointer = pointer + 1
+        if pointer < len(queue):
+            return queue[pointer]
+        return None
+
+    def get_call_action(self, mock_obj, args, kwargs):
+        """Finds recorded action for the mock call in replay mode.
+
+        Stubs of the mock are checked first, then the next expected call
+        is taken from the expectation queue.
+
+        :param mock_obj: Called MethodMock object.
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        :return: MockCallAction object.
+        :raise: CallSequenceError or UnexpectedCall if call is unexpected.
+        """
+        find = self.__replay_stubs.get(mock_obj)
+        if find is not None:
+            action = find(args, kwargs)
+            if action is not None:
+                return action
+
+        return self.__get_expected_action(mock_obj, args, kwargs)
+
+    def __get_expected_action(self, mock_obj, args, kwargs):
+        """Takes next expected action from the expectation queue."""
+        action = self.pop_current_record()
+
+        # Failure if there are no stubs and expectors in the queue.
+        if action is None:
+            self.raise_error(CallSequenceError(
+                'No more calls are expected. \n'
+                'Actual call: %s, with args: %s' %
+                (str(mock_obj), mock_obj._args_to_str(args, kwargs))))
+
+        if action.obj is not mock_obj or not action._compare_args(args,
+                                                                   kwargs):
+            err_str = ('Unexpected method call.\n'
+                       'Expected object: %s\n'
+                       'Expected args: %s\n'
+                       'Actual object: %s\n'
+                       'Actual args: %s\n')
+            fmt_params = (str(action.obj),
+                          mock_obj._args_to_str(action.args, action.kwargs),
+                          str(mock_obj), mock_obj._args_to_str(args, kwargs))
+            self.raise_error(UnexpectedCall(err_str % fmt_params))
+
+        return action
+
+    def make_call(self, mock_obj, args, kwargs):
+        """Finds recorded action for the mock call and returns its result.
+
+        :param mock_obj: Called MethodMock object.
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        :return: Result of the action.
+        """
+        if self.__call_locks is None:
+            return self.get_call_action(mock_obj, args, kwargs)._get_result(
+                *args, **kwargs)
+        action = self.count_call(mock_obj, args, kwargs)
+        return self.make_result(action, args, kwargs)
+
+    def count_call(self, mock_obj, args, kwargs):
+        """Finds recorded action for the mock call and counts the call.
+
+        :param mock_obj: Called MethodMock object.
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        :return: MockCallAction object, use make_result to get its result.
+        """
+        if self.__call_locks is None:
+            action = self.get_call_action(mock_obj, args, kwargs)
+            action._count_call()
+            return action
+
+        find = self.__replay_stubs.get(mock_obj)
+        if find is not None:
+            action = find(args, kwargs)
+            if action is not None:
+                self.count_action(action)
+                return action
+
+        # Times limit of the current expected action depends on its
+        # counter, so the call is counted under the queue lock.
+        with self.__queue_lock:
+            action = self.__get_expected_action(mock_obj, args, kwargs)
+            action._count_call()
+        return action
+
+    def count_action(self, action):
+        """Counts the call of found action.
+
+        :param action: MockCallAction object.
+        """
+        if self.__call_locks is None:
+            action._count_call()
+        else:
+            with self.__call_lock(action):
+                action._count_call()
+
+    def make_result(self, action, args, kwargs):
+        """Returns result of counted action.
+
+        :param action: MockCallAction object.
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        """
+        # Iterators can not be used by many threads at once.
+        if self.__call_locks is not None and action.has_shared_state:
+            with self.__call_lock(action):
+                return action._make_result(args, kwargs)
+        return action._make_result(args, kwargs)
+
+    def get_result(self, action, args, kwargs):
+        """Counts the call of found action and returns its result.
+
+        :param action: MockCallAction object.
+        :param args: Actual call args.
+        :param kwargs: Actual call keyword args.
+        :return: Result of the action.
+        """
+        if self.__call_locks is None:
+            return action._get_result(*args, **kwargs)
+        self.count_action(action)
+        return self.make_result(action, args, kwargs)
+
+    def __call_lock(self, action):
+        """Returns lock guarding the action in thread-safe replay mode."""
+        locks = self.__call_locks
+        return locks[(id(action) >> 4) % len(locks)]
 
     def create_ctor_mock(self, module, class_name, arg_spec,
                          is_stub, display_name):
@@ -376,6 +873,9 @@ class MockControl(object):
 
         if display_name is None:
             display_name = class_def.__name__
+        if self.__engine == ENGINE_DESCRIPTOR:
+            return mock_type_gen.init_fake_type(
+                self, class_def, display_name, is_stub)
         return mock_src_gen.init_fake_class(
             self, class_def, display_name, is_stub)
 
@@ -415,7 +915,8 @@ class MockControl(object):
             kind = func_def.kind
 
         return FuncDef(name=func_def.name, kind=kind, func=func,
-                       arg_spec=arg_spec, owner=func_def.owner)
+                       arg_spec=arg_spec, owner=func_def.owner,
+                       is_async=inspect.iscoroutinefunction(func))
 
     def create_mock(self, func_def, is_stub, display_name):
         """Creates mock for function or class/object method."""
@@ -428,8 +929,12 @@ class MockControl(object):
                              (func_def.name,))
 
         func_def = self._extend_func_def(func_def)
+        return self._install_mock(func_def, is_stub, display_name)
 
+    def _install_mock(self, func_def, is_stub, display_name):
+        """Replaces the function by new mock, also used by templates."""
         owner_mocks = self.__object_mocks.setdefault(func_def.owner, {})
+        prev_mock = owner_mocks.get(func_def.name, _MISSING)
 
         # None must be stored to do not rollback in case of tear_down.
         if func_def.name not in owner_mocks:
@@ -441,40 +946,203 @@ class MockControl(object):
             raise MockError('Method "%s" is already mocked!' % (func_def.name,))
 
         if is_stub:
-            new_mock = MethodStub(func_def, self, display_name)
+            mock = new_stub(func_def, self, display_name)
         else:
-            new_mock = MethodMock(func_def, self, display_name)
-        owner_mocks[func_def.name] = new_mock
+            mock = new_mock(func_def, self, display_name)
+        owner_mocks[func_def.name] = mock
+
+        setattr(func_def.owner, func_def.name, mock)
+        self.__log(_LOG_MOCK, func_def.owner, func_def.name, prev_mock)
 
-        setattr(func_def.owner, func_def.name, new_mock)
+        return mock
 
-        return new_mock
+    def __patch_attribute(self, owner, name, value):
+        """Sets attribute value restored by tear_down and rollback."""
+        owner_mocks = self.__object_mocks.setdefault(owner, {})
+        prev_mock = owner_mocks.get(name, _MISSING)
+        if prev_mock is not _MISSING and prev_mock is not None:
+            raise MockError('Attribute "%s" is already patched!' % (name,))
+        owner_mocks[name] = _AttributePatch(owner, name, value)
+        self.__log(_LOG_MOCK, owner, name, prev_mock)
 
     def _add_record(self, call_action):
         """Adds new MockCall action to an appropriate storage."""
 
         assert self.__record, 'The play mode is set'
 
+        obj = call_action.obj
+
         # Check if there is no stubs already exists.
-        for stub_action in self.__stubs.get(call_action.obj, []):
-            if call_action._compare_args(stub_action.args, stub_action.kwargs):
-                raise ValueError('Stub already exists!')
+        stubs = self.__stubs.get(obj)
+        if stubs is not None and stubs.find_duplicate(call_action) is not None:
+            raise ValueError('Stub already exists!')
 
+        exp_index = self.__exp_index.get(obj)
         if call_action.is_ordered:
 
             # If action is stub we should check if such doesn't exist already
             # in the expectation queue.
+            if (exp_index is not None and
+                    exp_index.find_duplicate(call_action) is not None):
+                raise ValueError('Pattern exists in the expect queue')
+
+        self.__store_record(call_action)
 
-            for e_call in self.__exp_queue:
-                if call_action._compare_args(e_call.args, e_call.kwargs):
-                    raise ValueError('Pattern exists in the expect queue')
+    def __store_record(self, call_action):
+        """Adds checked action to the stubs or the expectation queue."""
+        obj = call_action.obj
+        if call_action.is_ordered:
             # Create container for MethodMock stubs.
-            if call_action.obj not in self.__stubs:
-                self.__stubs[call_action.obj] = []
-            self.__stubs[call_action.obj].append(call_action)
+            stubs = self.__stubs.get(obj)
+            if stubs is None:
+                stubs = self.__stubs[obj] = ActionIndex()
+            stubs.add(call_action)
+            self._track_action(call_action)
+            self.__log(_LOG_STUB, obj)
         else:
             # Save as sequence if it is not a stub.
             self.__exp_queue.append(call_action)
+            exp_index = self.__exp_index.get(obj)
+            if exp_index is None:
+                exp_index = self.__exp_index[obj] = ActionIndex()
+            exp_index.add(call_action)
+            self.__log(_LOG_EXPECTATION, obj)
+
+    def add_table(self, obj, rows, is_static):
+        """Adds non-ordered actions returning a value for each row.
+
+        Rows are added to the stub index as one action table, actions are
+        made when rows are called for the first time. Interface is verified
+        once per each distinct set of arguments. Rows with matchers or
+        unhashable arguments are added as separate actions after the table.
+
+        :param obj: MethodMock object.
+        :param rows: Mapping or iterable of (call arguments, result) pairs.
+                Tuple of call arguments is used as positional args,
+                CallArgs as args and kwargs, other value as one argument.
+        :param is_static: Add static stub actions.
+        """
+        assert self.__record, 'The play mode is set'
+        self._save_current_action()
+        self.__current_action = None
+
+        if is_static:
+            storage = self.__static_stubs
+            exp_index = None
+            log_kind = _LOG_STATIC_STUB
+            dup_error = 'Static stub already exists!'
+        else:
+            storage = self.__stubs
+            exp_index = self.__exp_index.get(obj)
+            log_kind = _LOG_STUB
+            dup_error = 'Stub already exists!'
+        index = storage.get(obj)
+        if index is None:
+            index = storage[obj] = ActionIndex()
+
+        if isinstance(rows, Mapping):
+            calls = list(rows.keys())
+            values = list(rows.values())
+        else:
+            rows = list(rows)
+            calls = [call_args for call_args, _ in rows]
+            values = [value for _, value in rows]
+        table_rows, other_rows, samples = make_table_rows(calls, values)
+        for args, kwargs in samples:
+            obj._verify_interface(args, kwargs)
+        if len(table_rows) + len(other_rows) < len(calls):
+            raise ValueError(dup_error)
+        if index.has_any_duplicate(table_rows.keys()):
+            raise ValueError(dup_error)
+        if (exp_index is not None and
+                exp_index.has_any_duplicate(table_rows.keys())):
+            raise ValueError('Pattern exists in the expect queue')
+
+        # Row actions are called any times, so they are never tracked.
+        def make_action(key, value):
+            return MockCallAction._table_row(obj, key[0], dict(key[1]), value)
+
+        def make_state(key, value):
+            return MockCallAction._table_row_state(key[0], dict(key[1]),
+                                                   value)
+
+        index.add(ActionTable(table_rows, make_action, make_state))
+        self.__log(log_kind, obj)
+
+        for args, kwargs, value in other_rows:
+            action = MockCallAction._table_row(obj, args, kwargs, value)
+            if index.find_duplicate(action) is not None:
+                raise ValueError(dup_error)
+            if (exp_index is not None and
+                    exp_index.find_duplicate(action) is not None):
+                raise ValueError('Pattern exists in the expect queue')
+            index.add(action)
+            self.__log(log_kind, obj)
+
+    def _load_record(self, call_action, is_static, check):
+        """Adds action made by a template.
+
+        :param call_action: New MockCallAction object.
+        :param is_static: True for static stub action.
+        :param check: Check the action for duplicates.
+        """
+        assert self.__record, 'The play mode is set'
+        if not is_static:
+            if check:
+                self._add_record(call_action)
+            else:
+                self.__store_record(call_action)
+            return
+
+        if check:
+            static_stubs = self.__static_stubs.get(call_action.obj)
+            if (static_stubs is not None and
+                    static_stubs.find_duplicate(call_action) is not None):
+                raise ValueError('Static stub already exists!')
+        self.__store_static_action(call_action)
+
+    def capture_template(self):
+        """Captures recorded mocks and actions as a template.
+
+        Only mocks of functions and methods can be captured, mocks of fake
+        objects made by mock_class/mock_obj are not supported.
+
+        :return: ExpectationTemplate object.
+        """
+        assert self.__record, 'The play mode is set'
+        self._save_current_action()
+        self.__current_action = None
+
+        mocks = []
+        positions = {}
+        for owner_mocks in self.__object_mocks.values():
+            for mock in owner_mocks.values():
+                if isinstance(mock, _AttributePatch):
+                    raise MockError('Patched attribute can not be captured: '
+                                    '%s' % (mock.name,))
+                if mock is not None:
+                    positions[mock] = len(mocks)
+                    mocks.append(MockDef(mock._func_def,
+                                         isinstance(mock, MethodStub),
+                                         mock._display_name))
+
+        actions = []
+        # Expectations go first, so stubs with bound placeholders are
+        # checked against them.
+        sources = ([(action.obj, (action._get_state(),), False)
+                    for action in self.__exp_queue] +
+                   [(obj, stubs.states(), False)
+                    for obj, stubs in self.__stubs.items()] +
+                   [(obj, stubs.states(), True)
+                    for obj, stubs in self.__static_stubs.items()])
+        for obj, states, is_static in sources:
+            mock_pos = positions.get(obj)
+            if mock_pos is None:
+                raise MockError('Mock can not be captured: %s' % (obj,))
+            for state in states:
+                actions.append(make_action_def(mock_pos, state, is_static))
+
+        return ExpectationTemplate(tuple(mocks), tuple(actions))
 
     def _save_current_action(self):
         """Saves current action if new one is requested."""
@@ -35,3 +35,10 @@ class CallsNumberError(MockError):
     """Raised if stub is called more time than it is allowed."""
 
     pass
+
+
+class SerializationError(MockError):
+
+    """Raised if expectations can not be saved or loaded."""
+
+    pass
@@ -0,0 +1,87 @@
+"""File backed payloads returned by mocks.
+"""
+
+import mmap
+import os
+
+
+class FilePayload(object):
+
+    """Range of a file mapped to memory on first use.
+
+    All calls get the same read-only memoryview of the mapping, so large
+    payloads are neither read into memory nor copied. Slice the view to
+    get parts of the payload without copying.
+    """
+
+    __slots__ = ('path', 'offset', 'length', '_view')
+
+    def __init__(self, path, offset=0, length=None):
+        """Constructor.
+
+        :param path: File path.
+        :param offset: Start of the payload in the file.
+        :param length: Length of the payload, the rest of the file if None.
+        """
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError('Offset and length must be >= 0')
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self._view = None
+
+    def __reduce__(self):
+        # Mapping is not saved, it is made again on first use.
+        return FilePayload, (self.path, self.offset, self.length)
+
+    def __str__(self):
+        return '<File payload %s [%d:%s]>' % (self.path, self.offset,
+                                             self.length)
+
+    def view(self):
+        """Returns memoryview of the payload, maps the file if needed."""
+        view = self._view
+        if view is None:
+            view = self._view = self._map()
+        return view
+
+    @property
+    def is_mapped(self):
+        """True if the file is mapped to memory."""
+        return self._view is not None
+
+    def close(self):
+        """Releases the view and unmaps the file.
+
+        File is mapped again on next use. If slices of the view are still
+        in use, the mapping is closed when they are garbage collected.
+        """
+        view, self._view = self._view, None
+        if view is None:
+            return
+        mapped = view.obj
+        try:
+            view.release()
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        except BufferError:
+            pass
+
+    def _map(self):
+        """Maps payload range of the file to memory."""
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if self.length is None else self.offset + self.length
+            if self.offset > size or end > size:
+                raise ValueError('Payload range [%d:%d] is out of file %s '
+                                 'of size %d' % (self.offset, end, self.path,
+                                                 size))
+            if end == self.offset:
+                # Empty files can not be mapped.
+                return memoryview(b'')
+            # Mapping offset must be a multiple of the allocation
+            # granularity.
+            start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+            mapped = mmap.mmap(f.fileno(), end - start,
+                               access=mmap.ACCESS_READ, offset=start)
+        return memoryview(mapped)[self.offset - start:]
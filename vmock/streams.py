@@ -0,0 +1,87 @@
+"""Async iterators returned by mocks.
+"""
+
+import asyncio
+
+
+# Bound at import, stream delays never wait on a stubbed sleep.
+_sleep = asyncio.sleep
+
+# Single payloads that are split into slices rather than iterated.
+_SLICEABLE_TYPES = (bytes, bytearray, memoryview, str)
+
+
+async def _iterate(iterable):
+    """Async iterator over sync iterable."""
+    for item in iterable:
+        yield item
+
+
+class AsyncStream(object):
+
+    """Source of async iterators made for each mock call.
+
+    Items are taken from the source lazily, it may be sync or async
+    iterable. Sync iterables are iterated again on each call.
+    """
+
+    __slots__ = ('source', 'chunk_size', 'delay')
+
+    def __init__(self, source, chunk_size=None, delay=None):
+        """Constructor.
+
+        :param source: Sync or async iterable of items.
+        :param chunk_size: Yield lists of up to chunk_size items. Bytes
+                and strings are split into slices of chunk_size length.
+        :param delay: Seconds of virtual time before each yield. Virtual
+                clock of the MockControl is advanced if it is installed,
+                the stream only yields to the event loop.
+        """
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError('Chunk size must be > 0')
+        self.source = source
+        self.chunk_size = chunk_size
+        self.delay = delay
+
+    def __str__(self):
+        return '<Async stream of %s>' % (self.source,)
+
+    def open(self, clock=None):
+        """Returns new async iterator over the source.
+
+        :param clock: VirtualClock advanced by delays or None.
+        """
+        return self._stream(clock)
+
+    def _items(self):
+        """Async iterator of items or chunks without delay."""
+        source = self.source
+        chunk_size = self.chunk_size
+        if chunk_size is not None and isinstance(source, _SLICEABLE_TYPES):
+            return _iterate(source[i:i + chunk_size]
+                            for i in range(0, len(source), chunk_size))
+        if not hasattr(source, '__aiter__'):
+            source = _iterate(source)
+        if chunk_size is None:
+            return source
+        return self._chunks(source)
+
+    async def _chunks(self, items):
+        """Groups items into lists of chunk_size items."""
+        chunk = []
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    async def _stream(self, clock):
+        delay = self.delay
+        async for item in self._items():
+            if delay is not None:
+                if clock is not None:
+                    clock.advance(delay)
+                await _sleep(0)
+            yield item
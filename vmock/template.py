@@ -0,0 +1,260 @@
+"""Expectation templates.
+
+Template is an immutable copy of recorded mocks and actions. It is captured
+once and then instantiated against any number of MockControl objects.
+Instances share expected arguments, matchers and results with the template,
+only call counters are their own.
+
+Templates of module functions and class methods may be saved to a file
+and loaded by other processes, for example by each xdist worker.
+"""
+
+import importlib
+import inspect
+import pickle
+from collections import namedtuple
+
+from vmock import vmock_defs
+from vmock.methodmock import MethodMock
+from vmock.mockcallaction import MockCallAction
+from vmock.mockerrors import MockError
+from vmock.mockerrors import SerializationError
+
+
+# Mock created by MockControl.create_mock.
+MockDef = namedtuple('MockDef', ['func_def', 'is_stub', 'display_name'])
+
+# Recorded action of the mock at mock_pos in the template mocks, state is
+# made by MockCallAction._get_state.
+ActionDef = namedtuple('ActionDef', ['mock_pos', 'state', 'is_static',
+                                     'placeholders'])
+
+
+class Placeholder(object):
+
+    """Value that is bound when template is instantiated.
+
+    Placeholder may be used as an expected argument, keyword argument or
+    a result of the action.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Placeholder) and self.name == other.name
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((Placeholder, self.name))
+
+    def __repr__(self):
+        return 'Placeholder(%r)' % (self.name,)
+
+
+def make_action_def(mock_pos, state, is_static):
+    """Makes ActionDef of the recorded action state."""
+    args, kwargs, value = state[0], state[1], state[5]
+    names = set()
+    for val in args:
+        if isinstance(val, Placeholder):
+            names.add(val.name)
+    for val in kwargs.values():
+        if isinstance(val, Placeholder):
+            names.add(val.name)
+    if isinstance(value, Placeholder):
+        names.add(value.name)
+    return ActionDef(mock_pos, state, is_static, frozenset(names))
+
+
+FORMAT_VERSION = 2
+
+
+def _owner_path(owner):
+    """Returns (module name, class qualified name) of the mock owner."""
+    if inspect.ismodule(owner):
+        return owner.__name__, None
+    if inspect.isclass(owner) and '<locals>' not in owner.__qualname__:
+        if _find_owner(owner.__module__, owner.__qualname__) is owner:
+            return owner.__module__, owner.__qualname__
+    raise SerializationError(
+        'Mock owner can not be found by dotted path: %s' % (owner,))
+
+
+def _find_owner(module_name, qualname):
+    """Finds module or class by its dotted path."""
+    try:
+        owner = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    for name in (qualname.split('.') if qualname else ()):
+        owner = getattr(owner, name, None)
+    return owner
+
+
+def load_template(path):
+    """Loads template saved by ExpectationTemplate.save.
+
+    Mocked modules and classes are imported if needed.
+
+    :param path: File path.
+    :return: ExpectationTemplate object.
+    """
+    try:
+        with open(path, 'rb') as f:
+            version, mock_states, action_states = pickle.load(f)
+    except (pickle.UnpicklingError, AttributeError, ImportError,
+            EOFError, ValueError, TypeError) as e:
+        raise SerializationError('Can not load template %s: %s' % (path, e))
+    if version != FORMAT_VERSION:
+        raise SerializationError('Unsupported template format %s: %s' %
+                                 (version, path))
+
+    mocks = []
+    for module_name, qualname, name, kind, spec_key, is_async, is_stub, \
+            display_name in mock_states:
+        owner = _find_owner(module_name, qualname)
+        if owner is None:
+            raise SerializationError('Mock owner is not found: %s.%s' %
+                                     (module_name, qualname))
+        func_def = vmock_defs.FuncDef(
+            name=name, kind=kind, func=getattr(owner, name),
+            arg_spec=vmock_defs.arg_spec_from_key(spec_key), owner=owner,
+            is_async=is_async)
+        mocks.append(MockDef(func_def, is_stub, display_name))
+
+    actions = [make_action_def(mock_pos, state, is_static)
+               for mock_pos, state, is_static in action_states]
+    return ExpectationTemplate(tuple(mocks), tuple(actions))
+
+
+def _bind(value, bindings):
+    """Returns bound value of the placeholder or value itself."""
+    if isinstance(value, Placeholder):
+        return bindings[value.name]
+    return value
+
+
+class ExpectationTemplate(object):
+
+    """Immutable copy of recorded expectations.
+
+    Use MockControl.capture_template to make it.
+    """
+
+    def __init__(self, mocks, actions):
+        """Constructor.
+
+        :param mocks: Tuple of MockDef.
+        :param actions: Tuple of ActionDef in order they are loaded.
+        """
+        self.__mocks = mocks
+        self.__actions = actions
+        # Actions without parent mock, instances are their copies.
+        self.__prototypes = tuple(
+            MockCallAction._from_state(None, action_def.state)
+            for action_def in actions)
+        names = set()
+        for action_def in actions:
+            names.update(action_def.placeholders)
+        self.__placeholders = frozenset(names)
+
+    @property
+    def mocks(self):
+        """Mock definitions of the template."""
+        return self.__mocks
+
+    @property
+    def actions(self):
+        """Action definitions of the template."""
+        return self.__actions
+
+    @property
+    def placeholders(self):
+        """Names of placeholders that must be bound."""
+        return self.__placeholders
+
+    def instantiate(self, mc, **bindings):
+        """Installs template mocks and adds their actions to MockControl.
+
+        Mocked objects must be restored by the MockControl the template was
+        captured from before it is instantiated.
+
+        :param mc: MockControl object in record mode.
+        :param bindings: Values of placeholders by their names.
+        :return: List of new mocks in order of template mocks.
+        """
+        unknown = set(bindings) - self.__placeholders
+        if unknown:
+            raise MockError('Unknown placeholders: %s' %
+                            (', '.join(sorted(unknown)),))
+        missing = self.__placeholders - set(bindings)
+        if missing:
+            raise MockError('Placeholders are not bound: %s' %
+                            (', '.join(sorted(missing)),))
+
+        # Mocks and actions are undone if a bound action is a duplicate.
+        # Template actions were unique when captured, only bound values may
+        # make duplicates, so actions are checked from the first bound one.
+        check = False
+        with mc._atomic():
+            new_mocks = [mc._install_mock(*mock_def)
+                         for mock_def in self.__mocks]
+            for action_def, action in zip(self.__actions, self.__prototypes):
+                obj = new_mocks[action_def.mock_pos]
+                if not action_def.placeholders:
+                    mc._load_record(action._copy(obj), action_def.is_static,
+                                    check)
+                    continue
+                args = tuple(_bind(val, bindings) for val in action.args)
+                kwargs = {key: _bind(val, bindings)
+                          for key, val in action.kwargs.items()}
+                result_type, value = action.result
+                new_action = action._copy(
+                    obj, args, kwargs, (result_type, _bind(value, bindings)))
+                check = True
+                mc._load_record(new_action, action_def.is_static, True)
+        return new_mocks
+
+    def save(self, path):
+        """Saves the template to a file.
+
+        Mocks are saved by dotted paths of their modules and classes.
+        Expected arguments, matchers and results are pickled.
+
+        :param path: File path.
+        """
+        mock_states = []
+        for func_def, is_stub, display_name in self.__mocks:
+            module_name, qualname = _owner_path(func_def.owner)
+            mock_states.append((module_name, qualname, func_def.name,
+                                func_def.kind,
+                                vmock_defs.arg_spec_key(func_def.arg_spec),
+                                func_def.is_async, is_stub, display_name))
+
+        action_states = [(mock_pos, state, is_static)
+                         for mock_pos, state, is_static, _ in self.__actions]
+        data = (FORMAT_VERSION, mock_states, action_states)
+        try:
+            dump = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            self.__raise_pickling_error(action_states)
+            raise SerializationError('Template can not be saved: %s' % (e,))
+        with open(path, 'wb') as f:
+            f.write(dump)
+
+    def __raise_pickling_error(self, action_states):
+        """Finds the action that can not be pickled and reports it."""
+        for mock_pos, state, _ in action_states:
+            try:
+                pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError) as e:
+                func_def = self.__mocks[mock_pos].func_def
+                raise SerializationError(
+                    'Expectation of %s%s can not be saved: %s' %
+                    (func_def.name,
+                     MethodMock._args_to_str(state[0], state[1]), e))
@@ -64,3 +64,20 @@ def func_with_one_arg_and_many_other_kwargs(param1, **kwargs):
 
 def func_with_defaults(a=1, b=2):
     pass
+
+
+def func_with_kwonly_args(a, *, b, c=3):
+    pass
+
+
+async def async_func(a, b=2):
+    pass
+
+
+class AsyncClass(object):
+
+    async def fetch(self, key):
+        pass
+
+    def sync_method(self):
+        pass
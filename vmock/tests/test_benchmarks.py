@@ -0,0 +1,109 @@
+"""VMock micro-benchmarks.
+
+Benchmarks are skipped by default. Set VMOCK_BENCH_SCALE environment
+variable to run them, its value multiplies the number of iterations.
+"""
+
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+import unittest
+
+import some_classes as sc
+
+from vmock import mockcontrol
+from vmock import vmock_defs
+
+
+SCALE = int(os.environ.get('VMOCK_BENCH_SCALE', '0'))
+
+
+def per_call_ns(func, number):
+    """Best time of one call in nanoseconds."""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+@unittest.skipUnless(SCALE, 'Set VMOCK_BENCH_SCALE to run benchmarks')
+class TestVmockBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        # Garbage of previous benchmarks slows down collections.
+        gc.collect()
+        self.mc = mockcontrol.MockControl()
+        self.addCleanup(self.mc.tear_down)
+
+    def test_fake_method_call_overhead(self):
+        fake = self.mc.stub_class(sc.SimpleClass)
+        fake.method_with_one_arg(1).returns(2)
+        self.mc.replay()
+        number = 20000 * SCALE
+
+        mock = fake.method_with_one_arg
+        class_func = type(fake).method_with_one_arg
+        # Mock is bound to the instance on first access.
+        self.assertIs(mock, fake.__dict__['method_with_one_arg'])
+
+        bound_ns = per_call_ns(lambda: fake.method_with_one_arg(1), number)
+        generated_ns = per_call_ns(lambda: class_func(fake, 1), number)
+        # Bound mock skips the generated method and its mock lookup.
+        self.assertLess(bound_ns, generated_ns)
+        self.assertEqual(2, fake.method_with_one_arg(1))
+
+    def test_cached_fake_class_size(self):
+        number = 2000 * SCALE
+        big_class = type('BigClass', (object,), {
+            'method_%d' % i: sc.SimpleClass.method_with_one_arg
+            for i in range(5000)})
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            mc = mockcontrol.MockControl(engine)
+            mc.stub_class(big_class)
+            small_ns = per_call_ns(lambda: mc.stub_class(sc.SimpleClass),
+                                   number)
+            big_ns = per_call_ns(lambda: mc.stub_class(big_class), number)
+            # Cached fake costs the same regardless of class size.
+            self.assertLess(big_ns, small_ns * 3)
+
+    def test_recorded_action_memory(self):
+        number = 20000 * SCALE
+        mock = self.mc.make_mock()
+        args = [(i,) for i in range(number)]
+
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            for a in args:
+                action = mock(*a).returns(None)
+            self.mc.replay()
+            after, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertFalse(hasattr(action, '__dict__'))
+        # Action object is a small part of the memory per expectation.
+        self.assertLess(sys.getsizeof(action) * 2, (after - before) / number)
+
+    def test_returns_table_load(self):
+        number = 20000 * SCALE
+        rows = {i: i * 2 for i in range(number)}
+
+        table_mock = self.mc.make_mock()
+        start = timeit.default_timer()
+        table_mock.returns_table(rows)
+        table_time = timeit.default_timer() - start
+
+        row_mock = self.mc.make_mock()
+        start = timeit.default_timer()
+        for key, value in rows.items():
+            row_mock(key).returns(value).anyorder()
+        self.mc.replay()
+        rows_time = timeit.default_timer() - start
+
+        self.assertLess(table_time * 10, rows_time)
+        self.assertEqual(number * 2 - 2, table_mock(number - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,28 @@
 """VMock library test.
 """
 
+import asyncio
+import concurrent.futures
+import gc
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 
 import some_classes as sc
 
+from vmock import iface_cache
+from vmock import matchers
+from vmock import methodmock
+from vmock import mock_src_gen
 from vmock import mockcontrol
 from vmock import mockerrors
+from vmock import template
+from vmock import vmock_defs
 
 
 class TestVmockMatchers(unittest.TestCase):
@@ -29,6 +45,12 @@ class TestVmockMatchers(unittest.TestCase):
         sc.func_with_one_arg = self.orig_f
         sc.simple_func = self.orig_f2
 
+    def make_temp_dir(self):
+        """Makes temporary directory removed after the test."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        return temp_dir.name
+
     def test_restore_one_func(self):
         orig_simple_func = sc.simple_func
         self.mc.mock_method(sc, 'simple_func')
@@ -335,5 +357,1049 @@ class TestVmockMatchers(unittest.TestCase):
         self.assertEqual(2, m1(1))
         self.assertEqual(3, m0(2, 2))
 
+    def test_stub_lookup_many_exact_args(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        for i in range(1000):
+            f1(i).returns(i * 2).anyorder()
+        f1([1]).returns('list').anyorder()
+        self.mc.replay()
+        self.assertEqual(0, f1(0))
+        self.assertEqual(1998, f1(999))
+        self.assertEqual('list', f1([1]))
+        self.assertRaises(mockerrors.CallSequenceError, f1, 1000)
+
+    def test_stub_lookup_matcher_priority(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(matchers.is_int()).returns('int').anyorder()
+        f1('x').returns('exact').anyorder()
+        f1(matchers.is_float()).returns('float').anyorder()
+        f1(7).returns('late exact').anyorder()
+        self.mc.replay()
+        self.assertEqual('int', f1(7))
+        self.assertEqual('exact', f1('x'))
+        self.assertEqual('float', f1(2.5))
+        self.mc.verify()
+
+    def test_static_stub_many_exact_args(self):
+        f1 = self.mc.stub_method(sc, 'func_with_one_arg')
+        for i in range(1000):
+            f1(i).returns(i * 2)
+        f1(matchers.is_str()).returns('str')
+        self.assertRaises(ValueError, self.mc.get_new_static_action,
+                          f1, (10,), {})
+        self.assertEqual(1998, f1(999))
+        self.assertEqual('str', f1('x'))
+        self.mc.replay()
+        self.assertEqual(0, f1(0))
+        self.assertRaises(mockerrors.CallSequenceError, f1, 1000)
+
+    def test_duplicate_stub_and_expectation(self):
+        f1 = self.mc.make_mock()
+        f2 = self.mc.make_mock()
+        f1(1).returns(1)
+        f1(2).returns(2).anyorder()
+        f1(2)
+        self.assertRaises(ValueError, f2)
+
+        mc = mockcontrol.MockControl()
+        f1 = mc.make_mock()
+        f1(1).returns(1)
+        f1(matchers.is_int()).anyorder()
+        self.assertRaises(ValueError, mc.replay)
+
+    def test_same_args_for_different_mocks(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f2 = self.mc.mock_method(sc, 'func_with_one_arg_and_many')
+        f1(1).returns(1)
+        f2(1).returns(2).anyorder()
+        self.mc.replay()
+        self.assertEqual(2, f2(1))
+        self.assertEqual(1, f1(1))
+        self.mc.verify()
+
+    def test_interface_check_kwonly_args(self):
+        s_func = self.mc.stub_method(sc, 'func_with_kwonly_args')
+        s_func(1, b=2)
+        s_func(1, b=2, c=4)
+        self.assertRaises(mockerrors.InterfaceError, s_func, 1, 2)
+        self.assertRaises(mockerrors.InterfaceError, s_func, 1, b=2, d=4)
+
+    def test_mock_weak_reference(self):
+        mock = self.mc.make_mock()
+        stub = self.mc.make_stub()
+        self.assertIs(mock, weakref.ref(mock)())
+        self.assertIs(stub, weakref.ref(stub)())
+
+    def test_interface_validator_is_shared(self):
+        m0 = self.mc.make_mock()
+        m1 = self.mc.make_mock()
+        self.assertIs(m0._validator, m1._validator)
+
+    def test_fake_class_is_cached(self):
+        m0 = self.mc.mock_class(sc.SimpleClass)
+        m1 = self.mc.mock_class(sc.SimpleClass)
+        s0 = self.mc.stub_class(sc.SimpleClass)
+        self.assertIs(type(m0), type(m1))
+        self.assertIsNot(type(m0), type(s0))
+        m0.method_with_one_arg(1).returns(1)
+        m1.method_with_one_arg(1).returns(2)
+        self.mc.replay()
+        self.assertEqual(1, m0.method_with_one_arg(1))
+        self.assertEqual(2, m1.method_with_one_arg(1))
+        self.mc.verify()
+
+    def test_fake_class_data_descriptor(self):
+        class Descriptor(object):
+            def __get__(self, obj, owner):
+                return 42
+
+        class WithDescriptor(object):
+            value = Descriptor()
+            number = 5
+
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            mc = mockcontrol.MockControl(engine)
+            fake = mc.mock_class(WithDescriptor)
+            self.assertEqual((42, 5), (fake.value, fake.number))
+
+    def test_fake_class_cache_invalidated(self):
+        class Changing(object):
+            def method(self):
+                pass
+
+        fake = self.mc.mock_class(Changing)
+        self.assertFalse(hasattr(fake, 'other_method'))
+        Changing.other_method = lambda self, a: None
+        fake = self.mc.mock_class(Changing)
+        fake.other_method(1)
+        self.assertRaises(mockerrors.InterfaceError, fake.other_method)
+        # Replaced attribute is not detected, it needs explicit invalidate.
+        Changing.other_method = lambda self: None
+        mock_src_gen.invalidate(Changing)
+        fake = self.mc.mock_class(Changing)
+        fake.other_method()
+        self.assertRaises(mockerrors.InterfaceError, fake.other_method, 1)
+
+        del fake, Changing
+        gc.collect()
+        self.assertFalse(any(c.__name__ == 'Changing'
+                             for c in mock_src_gen._class_cache.keys()))
+
+    def test_fake_class_of_patched_class(self):
+        class Service(object):
+            def fetch(self, key):
+                return 'REAL'
+
+        stub = self.mc.stub_method(Service, 'fetch')
+        stub(matchers.any_args()).returns('STUB')
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            fake = mockcontrol.MockControl(engine).stub_class(Service)
+            self.assertIsInstance(fake.fetch, methodmock.MethodMock)
+        self.mc.tear_down()
+
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            mc = mockcontrol.MockControl(engine)
+            fake = mc.stub_class(Service)
+            self.assertIsInstance(fake.fetch, methodmock.MethodMock)
+            fake.fetch(1).returns('FAKE')
+            self.assertRaises(mockerrors.InterfaceError, fake.fetch)
+            mc.replay()
+            self.assertEqual('FAKE', fake.fetch(1))
+
+    def test_interface_snapshot_disk_cache(self):
+        def fail_scan(class_def):
+            raise AssertionError('Class must not be scanned')
+
+        orig_scan = mock_src_gen._scan_class
+        with tempfile.TemporaryDirectory() as cache_dir:
+            iface_cache.set_cache_dir(cache_dir)
+            try:
+                mock_src_gen._class_cache.clear()
+                self.mc.mock_class(sc.SimpleClass)
+                self.assertEqual(1, len(os.listdir(cache_dir)))
+
+                mock_src_gen._class_cache.clear()
+                mock_src_gen._scan_class = fail_scan
+                m_class = self.mc.mock_class(sc.SimpleClass)
+            finally:
+                mock_src_gen._scan_class = orig_scan
+                iface_cache.set_cache_dir(None)
+
+        m_class.method_with_one_arg(1).returns(2)
+        self.assertRaises(mockerrors.InterfaceError,
+                          m_class.method_with_one_arg)
+        self.assertEqual(100, m_class.VARIABLE)
+        self.mc.replay()
+        self.assertEqual(2, m_class.method_with_one_arg(1))
+        self.mc.verify()
+
+    def test_interface_snapshot_of_patched_class_not_saved(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            iface_cache.set_cache_dir(cache_dir)
+            try:
+                mock_src_gen._class_cache.clear()
+                stub = self.mc.stub_method(sc.SimpleClass,
+                                           'method_with_one_arg')
+                stub(matchers.any_args()).returns(None)
+                self.mc.stub_class(sc.SimpleClass)
+                self.assertEqual([], os.listdir(cache_dir))
+                self.mc.tear_down()
+
+                mc = mockcontrol.MockControl()
+                fake = mc.stub_class(sc.SimpleClass)
+                self.assertEqual(1, len(os.listdir(cache_dir)))
+            finally:
+                iface_cache.set_cache_dir(None)
+                mock_src_gen._class_cache.clear()
+
+        self.assertIsInstance(fake.method_with_one_arg,
+                              methodmock.MethodMock)
+
+    def test_property_mocks_are_lazy(self):
+        m_class = self.mc.mock_class(sc.SimpleClass)
+        mocks = m_class._SimpleClass__m
+        self.assertEqual({}, mocks)
+        m_class.hl = 5
+        self.assertEqual(['hl__set_prop'], list(mocks))
+        self.mc.replay()
+        m_class.hl = 5
+        self.mc.verify()
+
+    def test_descriptor_engine_class_mock(self):
+        mc = mockcontrol.MockControl(vmock_defs.ENGINE_DESCRIPTOR)
+        m_class = mc.mock_class(sc.SimpleClass, display_name='simple.Class')
+        m_class.method_with_one_arg(1).returns(3)
+        m_class.hl = 6
+        m_class.hl.returns(11)
+        self.assertRaises(mockerrors.InterfaceError,
+                          m_class.method_with_one_arg, 1, 2)
+        mc.replay()
+        self.assertEqual(3, m_class.method_with_one_arg(1))
+        m_class.hl = 6
+        self.assertEqual(11, m_class.hl)
+        self.assertEqual(100, m_class.VARIABLE)
+        mc.verify()
+
+    def test_descriptor_engine_generated_class(self):
+        namespace = {'method_%d' % i: lambda self, a: None
+                     for i in range(2000)}
+        namespace['not an identifier'] = lambda self: None
+        namespace['__len__'] = lambda self: 0
+        generated = type('Generated', (object,), namespace)
+
+        mc = mockcontrol.MockControl(vmock_defs.ENGINE_DESCRIPTOR)
+        fake = mc.stub_class(generated)
+        fake.method_1999(1).returns(2)
+        getattr(fake, 'not an identifier')().returns(3)
+        fake.__len__().returns(4)
+        mc.replay()
+        self.assertEqual(2, fake.method_1999(1))
+        self.assertEqual(3, getattr(fake, 'not an identifier')())
+        self.assertEqual(4, len(fake))
+        self.assertRaises(mockerrors.CallSequenceError, fake.method_0, 1)
+
+    def test_compiled_args_comparison(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg_and_many_other_kwargs')
+        f1(1, a=matchers.is_int(), b='x').returns(1).anyorder()
+        f1(matchers.is_str(), a=[1]).returns(2).anyorder()
+        f1(2, a=[1]).returns(3).anyorder()
+        f1(matchers.any_args()).returns(4).anyorder().times(2)
+        self.assertRaises(ValueError, self.mc.replay)
+
+        mc = mockcontrol.MockControl()
+        f1 = mc.make_mock()
+        f1(1, a=matchers.is_int(), b='x').returns(1).anyorder()
+        f1(matchers.is_str(), a=[1]).returns(2).anyorder()
+        f1(2, a=[1]).returns(3).anyorder()
+        mc.replay()
+        self.assertEqual(1, f1(1, b='x', a=5))
+        self.assertEqual(2, f1('s', a=[1]))
+        self.assertEqual(3, f1(2, a=[1]))
+        self.assertIsNone(mc.find_stub(f1, (1,), {'a': 5, 'c': 'x'}))
+        self.assertIsNone(mc.find_stub(f1, (2,), {'a': [2]}))
+        self.assertIsNone(mc.find_stub(f1, (2, 3), {'a': [1]}))
+
+    def test_replay_error_messages(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg', display_name='f1')
+        f1(1).returns(1)
+        f1(2).returns(2).times(2)
+        self.mc.replay()
+        self.assertEqual(1, f1(1))
+        self.assertEqual(2, f1(2))
+        with self.assertRaises(mockerrors.UnexpectedCall) as ctx:
+            f1(3)
+        self.assertEqual('Unexpected method call.\n'
+                         'Expected object: (MethodMock): f1\n'
+                         "Expected args: ([2], {})\n"
+                         'Actual object: (MethodMock): f1\n'
+                         "Actual args: ([3], {})\n", str(ctx.exception))
+
+    def test_verify_tracks_failed_actions(self):
+        f1 = self.mc.make_stub(display_name='f1')
+        f2 = self.mc.make_mock(display_name='f2')
+        for i in range(100):
+            f1(i).returns(i)
+            f2(i).returns(i).anyorder()
+        f1(100).times(2)
+        f2(100).anyorder().mintimes(1).maxtimes(2)
+        f2(102).anyorder().mintimes(1)
+        f2(101).anyorder().maxtimes(1)
+        self.mc.replay()
+        f1(100)
+        f2(100)
+        f2(101)
+        f2(101)
+        with self.assertRaises(mockerrors.CallsNumberError) as ctx:
+            self.mc.verify()
+        # Errors are reported in order of registration.
+        self.assertEqual(
+            ['(MethodMock): f2, with args: ([102], {}) - '
+             'Number of calls is only: 0 of 1',
+             '(MethodMock): f2, with args: ([101], {}) - Method called 2 of 1',
+             '(MethodMock): f1, with args: ([100], {}) - '
+             'Number of calls is only: 1 of 2'],
+            str(ctx.exception).split('\n'))
+        f1(100)
+        self.assertRaises(mockerrors.CallsNumberError, self.mc.verify)
+
+    def test_reset(self):
+        orig_simple_func = sc.simple_func
+        f1 = self.mc.mock_method(sc, 'simple_func')
+        f1().returns(1)
+        m_class = self.mc.mock_class(sc.SimpleClass)
+        m_class.method_with_one_arg(1).returns(3).anyorder()
+        self.mc.replay()
+        self.assertEqual(1, sc.simple_func())
+        self.assertRaises(mockerrors.CallSequenceError, sc.simple_func)
+
+        self.mc.reset()
+        self.assertEqual(orig_simple_func, sc.simple_func)
+        self.assertTrue(self.mc.is_recording())
+
+        f1 = self.mc.mock_method(sc, 'simple_func')
+        f1().returns(2)
+        m_class2 = self.mc.mock_class(sc.SimpleClass)
+        self.assertIs(type(m_class), type(m_class2))
+        self.mc.replay()
+        self.assertEqual(2, sc.simple_func())
+        self.assertRaises(mockerrors.CallSequenceError,
+                          m_class2.method_with_one_arg, 1)
+
+    def test_savepoint_rollback(self):
+        orig_simple_func = sc.simple_func
+        orig_func_with_one_arg = sc.func_with_one_arg
+        orig_func_with_kwonly_args = sc.func_with_kwonly_args
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub_action = stub().returns(1)
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns(2).anyorder().anytimes()
+        sp = self.mc.savepoint()
+
+        for _ in range(3):
+            f1(2).returns(3)
+            f1(3).returns(4).anyorder()
+            f2 = self.mc.mock_method(sc, 'func_with_kwonly_args')
+            f2(1, b=2).returns(5)
+            self.mc.replay()
+            self.assertEqual(1, sc.simple_func())
+            self.assertEqual(2, sc.func_with_one_arg(1))
+            self.assertEqual(3, sc.func_with_one_arg(2))
+            self.assertEqual(4, sc.func_with_one_arg(3))
+            self.assertEqual(5, sc.func_with_kwonly_args(1, b=2))
+
+            self.mc.rollback(sp)
+            self.assertTrue(self.mc.is_recording())
+            self.assertEqual(orig_func_with_kwonly_args,
+                             sc.func_with_kwonly_args)
+            self.assertEqual(0, stub_action.calls_counter)
+
+        self.mc.replay()
+        self.assertEqual(2, sc.func_with_one_arg(1))
+        self.assertRaises(mockerrors.CallSequenceError,
+                          sc.func_with_one_arg, 2)
+        self.mc.tear_down()
+        self.assertEqual(orig_simple_func, sc.simple_func)
+        self.assertEqual(orig_func_with_one_arg, sc.func_with_one_arg)
+
+    def test_rollback_calls_counters(self):
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub_action = stub().returns(1)
+        sc.simple_func()
+        sc.simple_func()
+        # Calls are not journaled without savepoints.
+        self.assertEqual([], self.mc._MockControl__called)
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1_action = f1(1).returns(2).anyorder()
+        sp = self.mc.savepoint()
+
+        for _ in range(2):
+            self.mc.replay()
+            sc.simple_func()
+            sc.simple_func()
+            sc.func_with_one_arg(1)
+            self.assertEqual(4, stub_action.calls_counter)
+            self.mc.rollback(sp)
+            self.assertEqual(2, stub_action.calls_counter)
+            self.assertEqual(0, f1_action.calls_counter)
+
+    def test_rollback_invalid_savepoint(self):
+        sp = self.mc.savepoint()
+        self.mc.reset()
+        self.assertRaises(ValueError, self.mc.rollback, sp)
+
+    def test_expectation_template(self):
+        orig_simple_func = sc.simple_func
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub().returns(template.Placeholder('answer'))
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns(2)
+        f1(template.Placeholder('arg')).returns(3).anyorder()
+        f1(matchers.is_str()).returns(4).anyorder()
+        tmpl = self.mc.capture_template()
+        self.mc.tear_down()
+        self.assertEqual(orig_simple_func, sc.simple_func)
+        self.assertEqual({'answer', 'arg'}, tmpl.placeholders)
+
+        for i in range(3):
+            mc = mockcontrol.MockControl()
+            _, f2 = tmpl.instantiate(mc, answer=i, arg=i + 10)
+            self.assertIs(f2, sc.func_with_one_arg)
+            mc.replay()
+            self.assertEqual(i, sc.simple_func())
+            self.assertEqual(4, sc.func_with_one_arg('a'))
+            self.assertEqual(3, sc.func_with_one_arg(i + 10))
+            self.assertEqual(2, sc.func_with_one_arg(1))
+            mc.verify()
+            mc.tear_down()
+        self.assertEqual(orig_simple_func, sc.simple_func)
+
+        # Actions without placeholders share arguments with the template.
+        mc = mockcontrol.MockControl()
+        tmpl.instantiate(mc, answer=1, arg=2)
+        copy = mc.find_stub(sc.func_with_one_arg, ('a',), {})
+        self.assertTrue(any(copy.args is action_def.state[0]
+                            for action_def in tmpl.actions))
+        mc.tear_down()
+
+        mc = mockcontrol.MockControl()
+        self.assertRaises(mockerrors.MockError, tmpl.instantiate, mc)
+        self.assertRaises(mockerrors.MockError, tmpl.instantiate, mc,
+                          answer=1, arg=2, other=3)
+        # Bound argument duplicates the expectation, nothing is installed.
+        self.assertRaises(ValueError, tmpl.instantiate, mc, answer=1, arg=1)
+        self.assertEqual(orig_simple_func, sc.simple_func)
+        self.assertEqual(self.orig_f, sc.func_with_one_arg)
+        tmpl.instantiate(mc, answer=1, arg=2)
+        mc.tear_down()
+
+        # Template keeps no references to the captured MockControl.
+        mc_ref = weakref.ref(self.mc)
+        self.mc = mockcontrol.MockControl()
+        del stub, f1
+        gc.collect()
+        self.assertIsNone(mc_ref())
+
+    def test_template_bound_duplicate_of_later_action(self):
+        stub = self.mc.stub_method(sc, 'func_with_one_arg')
+        stub(template.Placeholder('x')).returns(1)
+        stub(2).returns(2)
+        tmpl = self.mc.capture_template()
+        self.mc.tear_down()
+
+        mc = mockcontrol.MockControl()
+        self.assertRaises(ValueError, tmpl.instantiate, mc, x=2)
+        self.assertEqual(self.orig_f, sc.func_with_one_arg)
+        tmpl.instantiate(mc, x=3)
+        mc.replay()
+        self.assertEqual([1, 2], [sc.func_with_one_arg(3),
+                                  sc.func_with_one_arg(2)])
+        mc.tear_down()
+
+    def test_template_of_fake_object(self):
+        m_class = self.mc.mock_class(sc.SimpleClass)
+        m_class.method_with_one_arg(1).returns(3)
+        self.assertRaises(mockerrors.MockError, self.mc.capture_template)
+
+    def test_save_and_load_template(self):
+        orig_simple_func = sc.simple_func
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub().returns(template.Placeholder('answer'))
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns(2)
+        f1(matchers.is_str()).raises(KeyError('a')).anyorder()
+        f1(matchers.dict_contains({'a': 1})).returns(4).anyorder().twice()
+        m_static = self.mc.stub_method(sc.SimpleClass,
+                                        'static_method_with_two_args')
+        m_static(matchers.any_args()).returns(5)
+        tmpl = self.mc.capture_template()
+        self.mc.tear_down()
+
+        path = os.path.join(self.make_temp_dir(), 'expectations')
+        tmpl.save(path)
+        loaded = template.load_template(path)
+        self.assertEqual(tmpl.placeholders, loaded.placeholders)
+
+        mc = mockcontrol.MockControl()
+        loaded.instantiate(mc, answer=1)
+        mc.replay()
+        self.assertEqual(1, sc.simple_func())
+        self.assertRaises(KeyError, sc.func_with_one_arg, 'a')
+        self.assertEqual(4, sc.func_with_one_arg({'a': 1, 'b': 2}))
+        self.assertEqual(2, sc.func_with_one_arg(1))
+        self.assertEqual(
+            5, sc.SimpleClass.static_method_with_two_args(1, 2))
+        self.assertRaises(mockerrors.CallsNumberError, mc.verify)
+        mc.tear_down()
+        self.assertEqual(orig_simple_func, sc.simple_func)
+
+    def test_save_template_errors(self):
+        path = os.path.join(self.make_temp_dir(), 'expectations')
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(matchers.CustomMatcher(lambda x: x > 1)).returns(1)
+        self.assertRaisesRegex(mockerrors.SerializationError,
+                               'func_with_one_arg',
+                               self.mc.capture_template().save, path)
+        self.mc.tear_down()
+
+        mc = mockcontrol.MockControl()
+        mc.make_mock()().returns(1)
+        self.assertRaises(mockerrors.SerializationError,
+                          mc.capture_template().save, path)
+
+    def test_returns_table(self):
+        f1 = self.mc.mock_method(sc, 'func_with_defaults')
+        f1(matchers.is_str()).returns('str').anyorder()
+        f1.returns_table([(1, 10), ((2, 3), 23),
+                          (vmock_defs.CallArgs((4,), {'b': 5}), 45),
+                          (([6],), 6)])
+        f1(7).returns(70)
+        self.assertRaises(ValueError, f1.returns_table, [(1, 11)])
+        self.assertRaises(mockerrors.InterfaceError, f1.returns_table,
+                          [((1, 2, 3), 0)])
+
+        stub = self.mc.stub_method(sc, 'func_with_one_arg')
+        stub.returns_table((i, i * 2) for i in range(1000))
+        self.assertEqual(20, stub(10))
+        self.assertRaises(ValueError, stub.returns_table, {10: 1})
+        # Duplicates inside one table.
+        self.assertRaises(ValueError, stub.returns_table,
+                          [(-1, 1), (-1, 2)])
+        self.assertRaises(ValueError, f1.returns_table,
+                          [((8, 9), 1), ((8, 9), 2)])
+        self.assertRaises(ValueError, f1.returns_table,
+                          [(8, 1), (vmock_defs.CallArgs((8,), {}), 2)])
+
+        self.mc.replay()
+        self.assertEqual('str', sc.func_with_defaults('1'))
+        self.assertEqual(10, sc.func_with_defaults(1))
+        self.assertEqual(10, sc.func_with_defaults(1))
+        self.assertEqual(23, sc.func_with_defaults(2, 3))
+        self.assertEqual(45, sc.func_with_defaults(4, b=5))
+        self.assertEqual(6, sc.func_with_defaults([6]))
+        self.assertEqual(70, sc.func_with_defaults(7))
+        self.assertEqual(1998, sc.func_with_one_arg(999))
+        self.mc.verify()
+        self.assertRaises(mockerrors.CallSequenceError,
+                          sc.func_with_one_arg, 1000)
+
+    def test_returns_table_rows_made_lazily(self):
+        stub = self.mc.stub_method(sc, 'func_with_one_arg')
+        stub.returns_table({i: i * 2 for i in range(100)})
+        stub.returns_table([(matchers.is_str(), 's')])
+        table = next(iter(self.mc._MockControl__static_stubs[stub]._actions))
+        self.assertEqual(4, stub(2))
+
+        tmpl = self.mc.capture_template()
+        self.assertEqual(101, len(tmpl.actions))
+        self.assertEqual(1, len(table.actions))
+        stub.redefine(1).returns(0)
+        self.assertEqual(1, len(table.actions))
+        self.mc.tear_down()
+
+        mc = mockcontrol.MockControl()
+        tmpl.instantiate(mc)
+        mc.replay()
+        self.assertEqual([198, 's'], [sc.func_with_one_arg(99),
+                                      sc.func_with_one_arg('a')])
+        mc.tear_down()
+
+    def test_fake_method_returns_table(self):
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            mc = mockcontrol.MockControl(engine)
+            fake = mc.stub_class(sc.SimpleClass)
+            # Method mock is available before its first call.
+            self.assertIsInstance(fake.method_with_one_arg,
+                                  methodmock.MethodStub)
+            fake.method_with_one_arg.returns_table({1: 2, 3: 4})
+            mc.replay()
+            self.assertEqual(2, fake.method_with_one_arg(1))
+            self.assertEqual(4, fake.method_with_one_arg(3))
+
+    def test_returns_table_rollback(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1.returns_table({1: 10})
+        sp = self.mc.savepoint()
+        f1.returns_table({2: 20})
+        self.mc.rollback(sp)
+        f1.returns_table({2: 30})
+        self.mc.replay()
+        self.assertEqual(10, sc.func_with_one_arg(1))
+        self.assertEqual(30, sc.func_with_one_arg(2))
+
+    def test_returns_from(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_from(range(1, 4)).anyorder()
+        f1(2).returns_cycle([1, 2]).anyorder()
+        f1(3).returns_cycle(iter('ab')).anyorder()
+        f1(4).returns_from(itertools.count()).anyorder()
+        self.mc.replay()
+
+        self.assertEqual([1, 2, 3], [sc.func_with_one_arg(1)
+                                     for _ in range(3)])
+        self.assertEqual([1, 2, 1, 2, 1], [sc.func_with_one_arg(2)
+                                           for _ in range(5)])
+        self.assertEqual(['a', 'b', 'a'], [sc.func_with_one_arg(3)
+                                           for _ in range(3)])
+        self.assertEqual(9999, [sc.func_with_one_arg(4)
+                                for _ in range(10000)][-1])
+        self.mc.verify()
+
+        self.assertRaises(mockerrors.CallsNumberError,
+                          sc.func_with_one_arg, 1)
+        self.assertRaisesRegex(mockerrors.CallsNumberError,
+                               'exhausted after 3 calls', self.mc.verify)
+
+    def test_returns_from_rollback(self):
+        def numbers():
+            yield 1
+            yield 2
+
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_from([1, 2]).twice()
+        f1(2).returns_from(numbers).anyorder()
+        f1(3).returns_cycle(iter('ab')).anyorder()
+        f1(4).returns_from(iter(range(10))).anyorder()
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub().returns_from(numbers)
+        # Value returned before the savepoint is not returned again.
+        self.assertEqual(1, sc.simple_func())
+        sp = self.mc.savepoint()
+        for i in range(2):
+            self.mc.replay()
+            self.assertEqual(1, sc.func_with_one_arg(1))
+            self.assertEqual(2, sc.func_with_one_arg(1))
+            self.assertEqual([1, 2], [sc.func_with_one_arg(2)
+                                      for _ in range(2)])
+            self.assertEqual(['a', 'b', 'a'], [sc.func_with_one_arg(3)
+                                               for _ in range(3)])
+            self.assertEqual(2, sc.simple_func())
+            # Iterator is not started again.
+            self.assertEqual(i, sc.func_with_one_arg(4))
+            self.mc.verify()
+            self.mc.rollback(sp)
+
+    def test_returns_from_keeps_no_values(self):
+        class Value(object):
+            pass
+
+        refs = []
+
+        def values():
+            while True:
+                value = Value()
+                refs.append(weakref.ref(value))
+                yield value
+
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub().returns_from(values())
+        self.mc.replay()
+        for _ in range(3):
+            sc.simple_func()
+        gc.collect()
+        # The last value is kept by the generator frame itself.
+        self.assertEqual([None, None], [ref() for ref in refs[:-1]])
+
+    def test_returns_from_template(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_cycle(iter('ab')).anyorder()
+        f1(2).returns_from(lambda: (i * 2 for i in range(3))).anyorder()
+        tmpl = self.mc.capture_template()
+        self.mc.tear_down()
+
+        # Each instance starts from the first value.
+        for _ in range(2):
+            mc = mockcontrol.MockControl()
+            tmpl.instantiate(mc)
+            mc.replay()
+            self.assertEqual(['a', 'b', 'a'], [sc.func_with_one_arg(1)
+                                               for _ in range(3)])
+            self.assertEqual([0, 2], [sc.func_with_one_arg(2)
+                                      for _ in range(2)])
+            mc.tear_down()
+
+    def test_returns_file(self):
+        tmp_dir = self.make_temp_dir()
+        path = os.path.join(tmp_dir, 'payload')
+        data = bytes(range(256)) * 100
+        with open(path, 'wb') as f:
+            f.write(data)
+        empty_path = os.path.join(tmp_dir, 'empty')
+        open(empty_path, 'wb').close()
+
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_file(path).anyorder()
+        f1(2).returns_file(path, 10000, 100).anyorder()
+        f1(3).returns_file(empty_path).anyorder()
+        f1(4).returns_file(path, len(data) + 1).anyorder()
+        self.mc.replay()
+
+        view = sc.func_with_one_arg(1)
+        self.assertIsInstance(view, memoryview)
+        self.assertTrue(view.readonly)
+        self.assertEqual(data, view)
+        self.assertIs(view, sc.func_with_one_arg(1))
+        self.assertEqual(data[10010:10020], sc.func_with_one_arg(2)[10:20])
+        self.assertEqual(b'', sc.func_with_one_arg(3))
+        self.assertRaises(ValueError, sc.func_with_one_arg, 4)
+        # Range error is reported by verify too.
+        self.assertRaises(ValueError, self.mc.verify)
+
+        # Mapping is closed by tear_down.
+        self.mc.tear_down()
+        self.assertRaises(ValueError, bytes, view)
+
+    def test_thread_safe_replay(self):
+        threads_num = 8
+        calls_num = 2000
+        total = threads_num * calls_num
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns(1).times(total)
+        f1(2).returns(2).anyorder().times(total)
+        f1(3).returns_from(range(total)).anyorder()
+        f1.returns_table({4: 4})
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub_action = stub().returns(5)
+        self.mc.replay(thread_safe=True)
+        # Switch threads often to make races likely.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def worker():
+            values = []
+            for _ in range(calls_num):
+                self.assertEqual(1, sc.func_with_one_arg(1))
+                self.assertEqual(2, sc.func_with_one_arg(2))
+                values.append(sc.func_with_one_arg(3))
+                self.assertEqual(4, sc.func_with_one_arg(4))
+                self.assertEqual(5, sc.simple_func())
+            return values
+
+        with concurrent.futures.ThreadPoolExecutor(threads_num) as pool:
+            futures = [pool.submit(worker) for _ in range(threads_num)]
+            values = [v for f in futures for v in f.result()]
+
+        self.assertEqual(list(range(total)), sorted(values))
+        self.assertEqual(total, stub_action.calls_counter)
+        self.mc.verify()
+
+    def test_async_function_mock(self):
+        orig_async_func = sc.async_func
+        f1 = self.mc.mock_method(sc, 'async_func')
+        self.assertIsInstance(f1, methodmock.AsyncMethodMock)
+        f1(1).returns(10)
+        f1(2).raises(KeyError('b'))
+
+        async def double(a, b=2):
+            await asyncio.sleep(0)
+            return a * b
+
+        f1(3, b=4).does(double)
+        self.assertRaises(mockerrors.InterfaceError, f1, 1, 2, 3)
+        self.mc.replay()
+
+        async def run():
+            self.assertEqual(10, await sc.async_func(1))
+            with self.assertRaises(KeyError):
+                await sc.async_func(2)
+            return await sc.async_func(3, b=4)
+
+        self.assertEqual(12, asyncio.run(run()))
+        self.mc.verify()
+        # Unexpected call fails immediately.
+        self.assertRaises(mockerrors.CallSequenceError, sc.async_func, 1)
+        self.mc.tear_down()
+        self.assertEqual(orig_async_func, sc.async_func)
+
+    def test_async_class_stub(self):
+        for engine in (vmock_defs.ENGINE_SOURCE,
+                       vmock_defs.ENGINE_DESCRIPTOR):
+            mc = mockcontrol.MockControl(engine)
+            fake = mc.stub_class(sc.AsyncClass)
+            fake.fetch(1).returns('a')
+            fake.fetch(2).returns('b')
+            fake.sync_method().returns('c')
+            mc.replay()
+
+            async def run():
+                return await asyncio.gather(fake.fetch(1), fake.fetch(2))
+
+            self.assertEqual(['a', 'b'], asyncio.run(run()))
+            self.assertEqual('c', fake.sync_method())
+
+    def test_returns_async_iter(self):
+        async def numbers(n):
+            for i in range(n):
+                await asyncio.sleep(0)
+                yield i
+
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_async_iter([1, 2, 3]).anyorder()
+        f1(2).returns_async_iter(range(5), chunk_size=2).anyorder()
+        f1(3).returns_async_iter(b'abcde', chunk_size=2).anyorder()
+        f1(4).returns_async_iter(numbers(3), delay=0.5).anyorder()
+        f2 = self.mc.mock_method(sc, 'async_func')
+        f2(1).returns_async_iter('xyz').anyorder()
+        self.mc.replay()
+
+        async def collect(stream):
+            return [item async for item in stream]
+
+        async def run():
+            return [await collect(sc.func_with_one_arg(1)),
+                    await collect(sc.func_with_one_arg(1)),
+                    await collect(sc.func_with_one_arg(2)),
+                    await collect(sc.func_with_one_arg(3)),
+                    await collect(sc.func_with_one_arg(4)),
+                    await collect(await sc.async_func(1))]
+
+        self.assertEqual([[1, 2, 3], [1, 2, 3], [[0, 1], [2, 3], [4]],
+                          [b'ab', b'cd', b'e'], [0, 1, 2], ['x', 'y', 'z']],
+                         asyncio.run(run()))
+
+    def test_returns_async_iter_delay_is_virtual(self):
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_async_iter(range(4), delay=30).anyorder()
+        self.mc.replay()
+
+        async def collect():
+            return [item async for item in sc.func_with_one_arg(1)]
+
+        started = time.perf_counter()
+        self.assertEqual([0, 1, 2, 3], asyncio.run(collect()))
+        self.assertLess(time.perf_counter() - started, 5)
+
+    def test_returns_async_iter_delay_advances_clock(self):
+        clock = self.mc.virtual_clock(start=1000)
+        self.assertIs(clock, self.mc.clock)
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).returns_async_iter('abc', delay=30).anyorder()
+        self.mc.replay()
+
+        async def collect():
+            return [(item, time.time())
+                    async for item in sc.func_with_one_arg(1)]
+
+        self.assertEqual([('a', 1030), ('b', 1060), ('c', 1090)],
+                         asyncio.run(collect()))
+        self.assertEqual(90, clock.elapsed)
+
+    def test_measure_concurrency_async(self):
+        fake = self.mc.stub_class(sc.AsyncClass)
+
+        async def fetch(key):
+            await asyncio.sleep(0)
+            return key
+
+        fake.fetch(matchers.is_type(int)).does(fetch)
+        self.mc.replay()
+        meter = fake.fetch.measure_concurrency()
+        self.assertIs(meter, fake.fetch.measure_concurrency())
+
+        async def run():
+            for i in range(3):
+                self.assertEqual(i, await fake.fetch(i))
+            self.assertEqual(1, meter.peak)
+            return await asyncio.gather(*[fake.fetch(i) for i in range(8)])
+
+        self.assertEqual(list(range(8)), asyncio.run(run()))
+        self.assertEqual(8, meter.peak)
+        self.assertEqual(11, meter.calls)
+        self.assertEqual(0, meter.in_flight)
+        histogram = meter.histogram()
+        self.assertEqual(set(range(9)), set(histogram))
+        meter.reset()
+        self.assertEqual((0, 0, {}), (meter.peak, meter.calls,
+                                      meter.histogram()))
+
+    def test_measure_concurrency_not_awaited(self):
+        fake = self.mc.stub_class(sc.AsyncClass)
+        meter = fake.fetch.measure_concurrency()
+
+        async def fetch(key):
+            await asyncio.sleep(0)
+            return key
+
+        fake.fetch(1).does(fetch)
+        self.mc.replay()
+
+        coro = fake.fetch(1)
+        self.assertEqual(0, meter.in_flight)
+        coro.close()
+        self.assertEqual((0, 0), (meter.in_flight, meter.calls))
+
+        # Coroutine closed while it waits is not in flight anymore.
+        coro = fake.fetch(1)
+        coro.send(None)
+        self.assertEqual(1, meter.in_flight)
+        coro.close()
+        self.assertEqual((0, 1), (meter.in_flight, meter.calls))
+
+    def test_measure_concurrency_serial_awaits(self):
+        fake = self.mc.stub_class(sc.AsyncClass)
+
+        async def fetch(key):
+            await asyncio.sleep(0)
+            return key
+
+        fake.fetch(matchers.is_type(int)).does(fetch)
+        self.mc.replay()
+        meter = fake.fetch.measure_concurrency()
+
+        async def run():
+            coros = [fake.fetch(i) for i in range(8)]
+            return [await coro for coro in coros]
+
+        self.assertEqual(list(range(8)), asyncio.run(run()))
+        self.assertEqual((1, 8), (meter.peak, meter.calls))
+
+    def test_measure_concurrency_replay_only(self):
+        stub = self.mc.stub_method(sc, 'func_with_one_arg')
+        stub(1).returns(2)
+        stub_meter = stub.measure_concurrency()
+        fake = self.mc.stub_class(sc.AsyncClass)
+        fake.fetch(1).returns(1)
+        fake_meter = fake.fetch.measure_concurrency()
+        self.assertEqual(2, sc.func_with_one_arg(1))
+        self.assertEqual(1, asyncio.run(fake.fetch(1)))
+        self.assertEqual((0, 0), (stub_meter.calls, fake_meter.calls))
+        self.mc.replay()
+
+        self.assertEqual(2, sc.func_with_one_arg(1))
+        self.assertEqual(1, asyncio.run(fake.fetch(1)))
+        self.assertEqual((1, 1), (stub_meter.calls, fake_meter.calls))
+
+    def test_measure_concurrency_threads(self):
+        threads_num = 4
+        barrier = threading.Barrier(threads_num)
+        f1 = self.mc.mock_method(sc, 'func_with_one_arg')
+        f1(1).does(lambda a: barrier.wait()).times(threads_num)
+        stub = self.mc.stub_method(sc, 'simple_func')
+        stub().does(lambda: barrier.wait())
+        self.mc.replay(thread_safe=True)
+        f1_meter = f1.measure_concurrency()
+        stub_meter = stub.measure_concurrency()
+
+        with concurrent.futures.ThreadPoolExecutor(threads_num) as pool:
+            for func, args in ((sc.func_with_one_arg, (1,)),
+                               (sc.simple_func, ())):
+                futures = [pool.submit(func, *args)
+                           for _ in range(threads_num)]
+                for future in futures:
+                    future.result()
+
+        for meter in (f1_meter, stub_meter):
+            self.assertEqual(threads_num, meter.peak)
+            self.assertEqual(threads_num, meter.calls)
+            self.assertEqual(0, meter.in_flight)
+            self.assertGreater(meter.histogram()[threads_num], 0)
+        self.mc.verify()
+
+    def test_virtual_clock(self):
+        orig_funcs = [getattr(time, name) for name in
+                      ('time', 'monotonic', 'perf_counter', 'sleep')]
+        clock = self.mc.virtual_clock(start=1000)
+        self.mc.replay()
+        real_start = orig_funcs[2]()
+
+        deadline = time.monotonic() + 600
+        delay = 1
+        attempts = 0
+        while time.monotonic() < deadline:
+            attempts += 1
+            time.sleep(delay)
+            delay *= 2
+
+        self.assertEqual(10, attempts)
+        self.assertEqual(1023, clock.elapsed)
+        self.assertEqual(2023, time.time())
+        self.assertEqual(1023, time.perf_counter())
+        clock.advance(0.5)
+        self.assertEqual(1023.5, time.monotonic())
+        self.assertRaises(ValueError, time.sleep, -1)
+        self.assertRaises(ValueError, clock.advance, -1)
+        self.assertLess(orig_funcs[2]() - real_start, 60)
+        self.assertRaises(mockerrors.MockError, self.mc.virtual_clock)
+        self.mc.tear_down()
+        self.assertEqual(orig_funcs, [getattr(time, name) for name in
+                                      ('time', 'monotonic', 'perf_counter',
+                                       'sleep')])
+
+    def test_virtual_clock_asyncio(self):
+        perf_counter = time.perf_counter
+        orig_funcs = (asyncio.sleep, asyncio.BaseEventLoop.time)
+        clock = self.mc.virtual_clock(start=1000)
+        self.mc.replay()
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            await asyncio.sleep(60)
+            self.assertEqual(60, time.monotonic())
+            self.assertEqual('done', await asyncio.wait_for(
+                asyncio.sleep(30, 'done'), timeout=5))
+            fired = loop.create_future()
+            loop.call_later(0.01, fired.set_result, True)
+            self.assertTrue(await fired)
+            return time.time()
+
+        started = perf_counter()
+        # Timeout is real, the loop would never reach it on frozen time.
+        self.assertEqual(1090, asyncio.run(asyncio.wait_for(run(), 10)))
+        self.assertLess(perf_counter() - started, 5)
+        self.assertEqual(90, clock.elapsed)
+        self.mc.tear_down()
+        self.assertEqual(orig_funcs,
+                         (asyncio.sleep, asyncio.BaseEventLoop.time))
+
+    def test_virtual_clock_loop_ignores_mock_errors(self):
+        self.mc.virtual_clock(start=1000)
+        self.mc.mock_method(sc, 'func_with_one_arg')
+        self.assertRaises(mockerrors.MockError, self.mc.capture_template)
+        self.mc.replay()
+        # Error saved by the unexpected call must not break event loops.
+        self.assertRaises(mockerrors.CallSequenceError,
+                          sc.func_with_one_arg, 1)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            fired = loop.create_future()
+            loop.call_later(0.01, fired.set_result, True)
+            return await fired
+
+        self.assertTrue(asyncio.run(asyncio.wait_for(run(), 10)))
+
+    def test_virtual_clock_rollback(self):
+        orig_funcs = (time.time, asyncio.BaseEventLoop.time)
+        savepoint = self.mc.savepoint()
+        self.mc.virtual_clock(start=1000)
+        self.mc.rollback(savepoint)
+        self.assertIsNone(self.mc.clock)
+        self.assertEqual(orig_funcs, (time.time, asyncio.BaseEventLoop.time))
+
+
 if __name__ == '__main__':
     unittest.main()
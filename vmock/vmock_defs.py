@@ -4,8 +4,13 @@ import inspect
 from collections import namedtuple
 
 
+# is_async is True for coroutine functions.
 FuncDef = namedtuple('FuncDef', ['name', 'kind', 'func',
-                                 'arg_spec', 'owner'])
+                                 'arg_spec', 'owner', 'is_async'],
+                     defaults=(False,))
+
+# Call arguments of a table row, see MethodMock.returns_table.
+CallArgs = namedtuple('CallArgs', ['args', 'kwargs'])
 
 NOT_MOCKABLE_METHODS = {
     '__class__', '__del__', '__dict__',
@@ -15,6 +20,13 @@ NOT_MOCKABLE_METHODS = {
 }
 
 
+# Fake class engines.
+# Generates fake class source code and executes it.
+ENGINE_SOURCE = 'source'
+# Builds fake class with type() and mock descriptors.
+ENGINE_DESCRIPTOR = 'descriptor'
+
+
 ANY_ARGS_SPEC = inspect.FullArgSpec(
     args=[], varargs='args', varkw='kwargs',
     defaults=None, kwonlyargs=[], kwonlydefaults=None,
@@ -31,3 +43,38 @@ NO_ARGS_SPEC = inspect.FullArgSpec(
     args=[], varargs=None, varkw=None,
     defaults=None, kwonlyargs=[], kwonlydefaults=None,
     annotations={})
+
+
+def arg_spec_key(arg_spec, skip_first=False):
+    """Makes hashable form of the argument specification.
+
+    Only details affecting a call interface are kept, so default values
+    and annotations are dropped.
+
+    :param arg_spec: inspect.FullArgSpec object.
+    :param skip_first: Skip first positional argument such as 'self'.
+    :return: Tuple of (args, varargs, varkw, number of defaults,
+            kwonlyargs, names of kwonly args with defaults).
+    """
+    args = tuple(arg_spec.args[1:] if skip_first else arg_spec.args)
+    defaults_num = len(arg_spec.defaults) if arg_spec.defaults else 0
+    kwonlydefaults = tuple(sorted(arg_spec.kwonlydefaults or ()))
+    return (args, arg_spec.varargs, arg_spec.varkw,
+            min(defaults_num, len(args)), tuple(arg_spec.kwonlyargs or ()),
+            kwonlydefaults)
+
+
+def arg_spec_from_key(spec_key):
+    """Makes inspect.FullArgSpec back from its hashable form.
+
+    Default values of the result are set to None.
+
+    :param spec_key: Result of arg_spec_key function.
+    """
+    args, varargs, varkw, defaults_num, kwonlyargs, kwonlydefaults = spec_key
+    return inspect.FullArgSpec(
+        args=list(args), varargs=varargs, varkw=varkw,
+        defaults=(None,) * defaults_num or None,
+        kwonlyargs=list(kwonlyargs),
+        kwonlydefaults={k: None for k in kwonlydefaults} or None,
+        annotations={})